@@ -1,29 +1,163 @@
 import json
 import os
 import secrets
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
 
-def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
 
 def verify_api_key(api_key: str, conn) -> bool:
     """Проверяет валидность API ключа для доступа к управлению ключами"""
     cur = conn.cursor()
     cur.execute(
-        "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
+        """SELECT id FROM api_keys
+        WHERE api_key = %s AND is_active = true
+          AND (expiry_date IS NULL OR expiry_date > NOW())""",
         (api_key,)
     )
     result = cur.fetchone()
     cur.close()
     return result is not None
 
+def invalidate_api_key_cache(cur) -> None:
+    """Увеличивает версию кэша API ключей, чтобы теплые функции сбросили свои записи"""
+    cur.execute(
+        """INSERT INTO cache_invalidations (cache_name, version, updated_at)
+        VALUES ('api_keys', 1, NOW())
+        ON CONFLICT (cache_name) DO UPDATE
+        SET version = cache_invalidations.version + 1, updated_at = NOW()"""
+    )
+
 def generate_api_key() -> str:
     """Генерирует безопасный API ключ"""
     random_part = secrets.token_urlsafe(32)[:24]
@@ -67,6 +201,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
+    
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -131,6 +267,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     WHERE id = %s""",
                     (new_api_key, key_id)
                 )
+                invalidate_api_key_cache(cur)
                 conn.commit()
                 cur.close()
                 conn.close()
@@ -226,6 +363,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 "DELETE FROM api_keys WHERE id = %s",
                 (key_id,)
             )
+            invalidate_api_key_cache(cur)
             conn.commit()
             cur.close()
             conn.close()
@@ -297,3 +435,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
         }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
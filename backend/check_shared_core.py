@@ -0,0 +1,91 @@
+"""Проверяет, что общее ядро доставки в send и retry не разошлось
+
+Функции развертываются независимо, поэтому ядро (кэши, транспорты, движок
+доставки, DeliveryUnitOfWork) скопировано в оба index.py между маркерами
+"# >>> общее ядро доставки" и "# <<< общее ядро доставки". Эталон - send.
+
+    python backend/check_shared_core.py        - код 1 и diff, если копии разошлись
+    python backend/check_shared_core.py --fix  - переписать блоки retry из send
+"""
+import difflib
+import os
+import sys
+from typing import List, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(BACKEND_DIR, 'send', 'index.py')
+COPIES = [os.path.join(BACKEND_DIR, 'retry', 'index.py')]
+BEGIN_MARKER = '# >>> общее ядро доставки'
+END_MARKER = '# <<< общее ядро доставки'
+
+def core_blocks(lines: List[str], path: str) -> List[Tuple[int, int]]:
+    """Границы блоков ядра: (строка после BEGIN, строка END) по порядку"""
+    blocks = []
+    start = None
+    for number, line in enumerate(lines):
+        if line.startswith(BEGIN_MARKER):
+            if start is not None:
+                raise ValueError(f'{path}:{number + 1}: nested {BEGIN_MARKER!r}')
+            start = number + 1
+        elif line.startswith(END_MARKER):
+            if start is None:
+                raise ValueError(f'{path}:{number + 1}: {END_MARKER!r} without begin')
+            blocks.append((start, number))
+            start = None
+    if start is not None:
+        raise ValueError(f'{path}: unterminated {BEGIN_MARKER!r}')
+    if not blocks:
+        raise ValueError(f'{path}: no shared core markers')
+    return blocks
+
+def read_lines(path: str) -> List[str]:
+    with open(path, encoding='utf-8') as f:
+        return f.read().splitlines(keepends=True)
+
+def check(fix: bool) -> bool:
+    """Сравнивает блоки каждой копии с эталоном, True - расхождений нет (или исправлены)"""
+    source_lines = read_lines(SOURCE)
+    source_blocks = core_blocks(source_lines, SOURCE)
+    in_sync = True
+    
+    for path in COPIES:
+        lines = read_lines(path)
+        blocks = core_blocks(lines, path)
+        if len(blocks) != len(source_blocks):
+            print(f"[SHARED CORE] {path}: {len(blocks)} blocks, expected {len(source_blocks)}")
+            in_sync = False
+            continue
+        
+        drifted = False
+        for (start, end), (source_start, source_end) in zip(blocks, source_blocks):
+            expected = source_lines[source_start:source_end]
+            actual = lines[start:end]
+            if actual != expected:
+                drifted = True
+                sys.stdout.writelines(difflib.unified_diff(
+                    expected, actual,
+                    fromfile=f'{SOURCE}:{source_start + 1}', tofile=f'{path}:{start + 1}'
+                ))
+        
+        if not drifted:
+            continue
+        if not fix:
+            print(f"[SHARED CORE] {path} differs from {SOURCE}")
+            in_sync = False
+            continue
+        
+        for (start, end), (source_start, source_end) in reversed(list(zip(blocks, source_blocks))):
+            lines[start:end] = source_lines[source_start:source_end]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        print(f"[SHARED CORE] {path} updated from {SOURCE}")
+    
+    return in_sync
+
+if __name__ == '__main__':
+    try:
+        ok = check('--fix' in sys.argv[1:])
+    except ValueError as e:
+        print(f"[SHARED CORE] {e}")
+        ok = False
+    sys.exit(0 if ok else 1)
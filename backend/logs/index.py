@@ -0,0 +1,389 @@
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
+
+def verify_api_key(api_key: str, conn) -> bool:
+    """Проверяет валидность API ключа"""
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT id FROM api_keys
+        WHERE api_key = %s AND is_active = true
+          AND (expiry_date IS NULL OR expiry_date > NOW())""",
+        (api_key,)
+    )
+    result = cur.fetchone()
+    cur.close()
+    return result is not None
+
+LOGS_DEFAULT_LIMIT = int(os.environ.get('LOGS_DEFAULT_LIMIT', '50'))
+LOGS_MAX_LIMIT = int(os.environ.get('LOGS_MAX_LIMIT', '200'))
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Курсор страницы: created_at и id последнего сообщения"""
+    payload = json.dumps({'created_at': created_at.isoformat(), 'id': row_id})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Разбирает курсор, ValueError - курсор поврежден"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.fromisoformat(payload['created_at']), int(payload['id'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def parse_time(value: Optional[str], field: str) -> Optional[datetime]:
+    """Граница периода из ISO 8601; время с часовым поясом переводится в UTC"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError as e:
+        raise ValueError(f'Invalid {field}') from e
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def query_messages(filters: Dict[str, Any], cursor: Optional[Tuple[datetime, int]], limit: int,
+                   include_attempts: bool, conn) -> List[Dict]:
+    """Страница сообщений от новых к старым, на одну строку больше limit
+    
+    Пагинация по ключу (created_at, id) без OFFSET: следующая страница начинается
+    сразу после последней строки предыдущей и идет по idx_messages_created_at.
+    Попытки доставки подтягиваются тем же запросом по idx_delivery_attempts_message_id;
+    условие по attempted_at (с запасом в сутки до создания сообщения) отсекает
+    более старые месячные партиции.
+    """
+    conditions = []
+    params: List[Any] = []
+    
+    if filters.get('statuses'):
+        conditions.append("m.status = ANY(%s)")
+        params.append(filters['statuses'])
+    if filters.get('provider'):
+        conditions.append("m.provider = %s")
+        params.append(filters['provider'])
+    if filters.get('recipient'):
+        conditions.append("m.recipient = %s")
+        params.append(filters['recipient'])
+    if filters.get('from'):
+        conditions.append("m.created_at >= %s")
+        params.append(filters['from'])
+    if filters.get('to'):
+        conditions.append("m.created_at < %s")
+        params.append(filters['to'])
+    if cursor:
+        conditions.append("(m.created_at, m.id) < (%s, %s)")
+        params.extend(cursor)
+    
+    attempts_column = "NULL AS delivery_attempts"
+    attempts_join = ""
+    if include_attempts:
+        attempts_column = "da.attempts AS delivery_attempts"
+        attempts_join = """
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object(
+                'attempt_number', a.attempt_number,
+                'provider', a.provider,
+                'status', a.status,
+                'response_code', a.response_code,
+                'error_code', a.error_code,
+                'error_message', a.error_message,
+                'provider_message_id', a.provider_message_id,
+                'duration_ms', a.duration_ms,
+                'attempted_at', a.attempted_at
+            ) ORDER BY a.attempted_at) AS attempts
+            FROM delivery_attempts a
+            WHERE a.message_id = m.message_id AND a.attempted_at >= m.created_at - INTERVAL '1 day'
+        ) da ON true"""
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(limit + 1)
+    
+    cur = conn.cursor()
+    cur.execute(
+        f"""SELECT m.id, m.message_id, m.provider, m.recipient, m.status, m.attempts, m.max_attempts,
+               m.last_error, m.provider_message_id, m.created_at, m.last_attempt_at,
+               m.next_attempt_at, m.completed_at, {attempts_column}
+        FROM messages m{attempts_join}
+        {where}
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT %s""",
+        params
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+def isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def message_entry(row: Dict) -> Dict[str, Any]:
+    entry = {
+        'message_id': row['message_id'],
+        'provider': row['provider'],
+        'recipient': row['recipient'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'max_attempts': row['max_attempts'],
+        'last_error': row['last_error'],
+        'provider_message_id': row['provider_message_id'],
+        'created_at': isoformat(row['created_at']),
+        'last_attempt_at': isoformat(row['last_attempt_at']),
+        'next_attempt_at': isoformat(row['next_attempt_at']),
+        'completed_at': isoformat(row['completed_at'])
+    }
+    if row['delivery_attempts'] is not None:
+        entry['delivery_attempts'] = row['delivery_attempts']
+    return entry
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Журнал сообщений и попыток доставки
+    
+    GET /api/logs?status=failed,queued&provider=sms_gateway&recipient=+79991234567
+                 &from=2026-01-01T00:00:00&to=2026-02-01T00:00:00&limit=50
+                 &include_attempts=true&cursor=...
+    Все параметры необязательны. Сообщения идут от новых к старым;
+    next_cursor из ответа передается в cursor для следующей страницы,
+    null - страниц больше нет. include_attempts добавляет к каждому
+    сообщению delivery_attempts (без тел ответов провайдера).
+    """
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method != 'GET':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = None
+    
+    try:
+        headers = event.get('headers', {})
+        api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
+        
+        if not api_key:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Missing API key'}),
+                'isBase64Encoded': False
+            }
+        
+        params = event.get('queryStringParameters') or {}
+        
+        try:
+            limit = int(params.get('limit') or LOGS_DEFAULT_LIMIT)
+            if not 0 < limit <= LOGS_MAX_LIMIT:
+                raise ValueError
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid limit', 'max': LOGS_MAX_LIMIT}),
+                'isBase64Encoded': False
+            }
+        
+        try:
+            cursor = decode_cursor(params['cursor']) if params.get('cursor') else None
+            filters = {
+                'statuses': [status for status in (params.get('status') or '').split(',') if status],
+                'provider': params.get('provider'),
+                'recipient': params.get('recipient'),
+                'from': parse_time(params.get('from'), 'from'),
+                'to': parse_time(params.get('to'), 'to')
+            }
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        
+        include_attempts = params.get('include_attempts') in ('true', '1')
+        
+        conn = get_db_connection()
+        
+        if not verify_api_key(api_key, conn):
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid API key'}),
+                'isBase64Encoded': False
+            }
+        
+        rows = query_messages(filters, cursor, limit, include_attempts, conn)
+        page = rows[:limit]
+        next_cursor = encode_cursor(page[-1]['created_at'], page[-1]['id']) if len(rows) > limit else None
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': True,
+                'messages': [message_entry(row) for row in page],
+                'next_cursor': next_cursor
+            }),
+            'isBase64Encoded': False
+        }
+        
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
@@ -0,0 +1,502 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Tuple
+import boto3
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
+
+def verify_api_key(api_key: str, conn) -> bool:
+    """Проверяет валидность API ключа"""
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT id FROM api_keys
+        WHERE api_key = %s AND is_active = true
+          AND (expiry_date IS NULL OR expiry_date > NOW())""",
+        (api_key,)
+    )
+    result = cur.fetchone()
+    cur.close()
+    return result is not None
+
+PARTITIONED_TABLE = 'delivery_attempts'
+DEFAULT_PARTITION = 'delivery_attempts_default'
+PARTITION_NAME_PATTERN = re.compile(r'^delivery_attempts_y(\d{4})m(\d{2})$')
+PARTITION_PREMAKE_MONTHS = int(os.environ.get('PARTITION_PREMAKE_MONTHS', '2'))
+ATTEMPTS_RETENTION_MONTHS = int(os.environ.get('ATTEMPTS_RETENTION_MONTHS', '6'))
+ARCHIVE_MAX_PARTITIONS = int(os.environ.get('ARCHIVE_MAX_PARTITIONS', '1'))
+ARCHIVE_S3_ENDPOINT = os.environ.get('ARCHIVE_S3_ENDPOINT', 'https://bucket.poehali.dev')
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', 'files')
+ARCHIVE_PREFIX = os.environ.get('ARCHIVE_PREFIX', 'archive/delivery_attempts')
+
+def shift_month(month: date, months: int) -> date:
+    """Первое число месяца, отстоящего от month на months месяцев"""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f'{PARTITIONED_TABLE}_y{month:%Y}m{month:%m}'
+
+def partition_month(name: str) -> Optional[date]:
+    """Месяц партиции по ее имени, None - это не месячная партиция"""
+    match = PARTITION_NAME_PATTERN.match(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+def list_partitions(conn) -> List[Dict[str, Any]]:
+    """Месячные партиции delivery_attempts, подключенные и отключенные (еще не заархивированные)"""
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT c.relname AS name, c.relispartition AS attached,
+               c.reltuples::BIGINT AS estimated_rows,
+               pg_total_relation_size(c.oid) AS size_bytes
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relkind = 'r' AND c.relname LIKE %s
+        ORDER BY c.relname""",
+        (f'{PARTITIONED_TABLE}_y%',)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    
+    partitions = []
+    for row in rows:
+        month = partition_month(row['name'])
+        if month is not None:
+            partitions.append({**row, 'month': month})
+    return partitions
+
+def default_partition_has_rows(month: date, cur) -> bool:
+    """Есть ли в delivery_attempts_default строки за месяц month"""
+    cur.execute(
+        sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE attempted_at >= %s AND attempted_at < %s) AS found").format(
+            sql.Identifier(DEFAULT_PARTITION)
+        ),
+        (month, shift_month(month, 1))
+    )
+    return cur.fetchone()['found']
+
+def create_partition(month: date, cur) -> int:
+    """Создает месячную партицию, возвращает число строк, перенесенных из delivery_attempts_default
+    
+    CREATE TABLE ... PARTITION OF падает, если в DEFAULT-партиции уже есть строки
+    этого месяца. Тогда партиция создается отдельной таблицей, строки переносятся
+    в нее из DEFAULT и она подключается - все в одной транзакции вызывающего.
+    """
+    name = partition_name(month)
+    bounds = (month, shift_month(month, 1))
+    
+    if not default_partition_has_rows(month, cur):
+        cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                sql.Identifier(name), sql.Identifier(PARTITIONED_TABLE)
+            ),
+            bounds
+        )
+        return 0
+    
+    cur.execute(
+        sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+            sql.Identifier(name), sql.Identifier(PARTITIONED_TABLE)
+        )
+    )
+    cur.execute(
+        sql.SQL("""WITH moved AS (
+            DELETE FROM {} WHERE attempted_at >= %s AND attempted_at < %s RETURNING *
+        )
+        INSERT INTO {} SELECT * FROM moved""").format(
+            sql.Identifier(DEFAULT_PARTITION), sql.Identifier(name)
+        ),
+        bounds
+    )
+    moved = cur.rowcount
+    cur.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+            sql.Identifier(PARTITIONED_TABLE), sql.Identifier(name)
+        ),
+        bounds
+    )
+    print(f"[RETENTION] Moved {moved} rows from {DEFAULT_PARTITION} to {name}")
+    return moved
+
+def ensure_partitions(today: date, months_ahead: int, conn) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Создает партиции с текущего месяца на months_ahead месяцев вперед
+    
+    Заранее созданные партиции не дают строкам попадать в delivery_attempts_default;
+    попавшие туда строки переносятся в новую партицию. Каждый месяц создается
+    в своей транзакции: ошибка одного месяца попадает в failed и не прерывает остальные.
+    Возвращает имена созданных партиций и ошибки.
+    """
+    current = today.replace(day=1)
+    existing = {partition['name'] for partition in list_partitions(conn)}
+    created, failed = [], []
+    
+    cur = conn.cursor()
+    for offset in range(months_ahead + 1):
+        month = shift_month(current, offset)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        try:
+            create_partition(month, cur)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"[RETENTION] Failed to create {name}: {e}")
+            failed.append({'partition': name, 'error': str(e).strip()})
+            continue
+        created.append(name)
+    cur.close()
+    return created, failed
+
+def get_archive_client():
+    """S3-клиент хранилища архивов, None - ключи доступа не заданы"""
+    if not os.environ.get('AWS_ACCESS_KEY_ID') or not os.environ.get('AWS_SECRET_ACCESS_KEY'):
+        return None
+    return boto3.client(
+        's3',
+        endpoint_url=ARCHIVE_S3_ENDPOINT,
+        aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+    )
+
+def detach_partition(name: str, conn) -> None:
+    cur = conn.cursor()
+    cur.execute(
+        sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+            sql.Identifier(PARTITIONED_TABLE), sql.Identifier(name)
+        )
+    )
+    conn.commit()
+    cur.close()
+
+def archive_partition(name: str, conn, s3) -> Dict[str, Any]:
+    """Выгружает отключенную партицию в CSV.gz в хранилище и удаляет ее таблицу
+    
+    Строки потоком пишутся через COPY во временный файл, поэтому партиция
+    не загружается в память целиком. Таблица удаляется только после загрузки.
+    """
+    key = f'{ARCHIVE_PREFIX}/{name}.csv.gz'
+    cur = conn.cursor()
+    
+    with tempfile.NamedTemporaryFile(suffix='.csv.gz') as archive:
+        with gzip.open(archive.name, 'wb') as gz:
+            cur.copy_expert(
+                sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name)).as_string(cur),
+                gz
+            )
+        size_bytes = os.path.getsize(archive.name)
+        s3.upload_file(archive.name, ARCHIVE_BUCKET, key, ExtraArgs={'ContentType': 'application/gzip'})
+    
+    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+    conn.commit()
+    cur.close()
+    
+    print(f"[RETENTION] Archived {name} to {ARCHIVE_BUCKET}/{key} ({size_bytes} bytes)")
+    return {'partition': name, 'key': key, 'size_bytes': size_bytes}
+
+def rotate_partitions(today: date, conn, s3, limit: int) -> Dict[str, Any]:
+    """Создает будущие партиции и архивирует до limit партиций старше срока хранения
+    
+    Партиция старше ATTEMPTS_RETENTION_MONTHS месяцев отключается от
+    delivery_attempts, выгружается в хранилище и удаляется. Без хранилища
+    (s3 = None) партиции не трогаются и возвращаются в pending_archive.
+    Отключенные, но не выгруженные прошлым запуском партиции архивируются первыми.
+    """
+    created, failed = ensure_partitions(today, PARTITION_PREMAKE_MONTHS, conn)
+    cutoff = shift_month(today.replace(day=1), -ATTEMPTS_RETENTION_MONTHS)
+    
+    expired = [
+        partition for partition in list_partitions(conn)
+        if not partition['attached'] or partition['month'] < cutoff
+    ]
+    expired.sort(key=lambda partition: (partition['attached'], partition['month']))
+    
+    if s3 is None:
+        return {
+            'created': created,
+            'failed': failed,
+            'archived': [],
+            'pending_archive': [partition['name'] for partition in expired],
+            'error': 'Archive storage is not configured'
+        }
+    
+    archived = []
+    for partition in expired[:limit]:
+        if partition['attached']:
+            detach_partition(partition['name'], conn)
+        archived.append(archive_partition(partition['name'], conn, s3))
+    
+    return {
+        'created': created,
+        'failed': failed,
+        'archived': archived,
+        'pending_archive': [partition['name'] for partition in expired[limit:]]
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Обслуживание таблицы delivery_attempts, разбитой на месячные партиции
+    
+    GET /api/maintenance - список партиций (месяц, подключена ли, оценка строк, размер)
+    POST /api/maintenance - ротация партиций (вызывается по таймеру)
+        Body: {"action": "rotate_partitions", "limit": 1}
+    
+    Ротация создает партиции на PARTITION_PREMAKE_MONTHS месяцев вперед
+    (строки, уже попавшие в delivery_attempts_default, переносятся в них;
+    месяцы, которые создать не удалось, возвращаются в failed),
+    а партиции старше ATTEMPTS_RETENTION_MONTHS месяцев (не больше limit за вызов)
+    отключает, выгружает в S3-хранилище файлом
+    ARCHIVE_PREFIX/delivery_attempts_yYYYYmMM.csv.gz и удаляет.
+    """
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method not in ('GET', 'POST'):
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = None
+    
+    try:
+        headers = event.get('headers', {})
+        api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
+        
+        if not api_key:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Missing API key'}),
+                'isBase64Encoded': False
+            }
+        
+        conn = get_db_connection()
+        
+        if not verify_api_key(api_key, conn):
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid API key'}),
+                'isBase64Encoded': False
+            }
+        
+        if method == 'GET':
+            partitions = list_partitions(conn)
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'retention_months': ATTEMPTS_RETENTION_MONTHS,
+                    'partitions': [
+                        {
+                            'name': partition['name'],
+                            'month': partition['month'].strftime('%Y-%m'),
+                            'attached': partition['attached'],
+                            'estimated_rows': max(partition['estimated_rows'], 0),
+                            'size_bytes': partition['size_bytes']
+                        }
+                        for partition in partitions
+                    ]
+                }),
+                'isBase64Encoded': False
+            }
+        
+        body_data = json.loads(event.get('body') or '{}')
+        action = body_data.get('action', 'rotate_partitions')
+        
+        if action != 'rotate_partitions':
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Unknown action', 'allowed': ['rotate_partitions']}),
+                'isBase64Encoded': False
+            }
+        
+        try:
+            limit = max(int(body_data.get('limit', ARCHIVE_MAX_PARTITIONS)), 0)
+        except (TypeError, ValueError):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid limit'}),
+                'isBase64Encoded': False
+            }
+        
+        result = rotate_partitions(datetime.now().date(), conn, get_archive_client(), limit)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, **result}),
+            'isBase64Encoded': False
+        }
+        
+    except json.JSONDecodeError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid JSON in request body'}),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
@@ -1,39 +1,205 @@
 import json
+import math
 import os
-from typing import Dict, Any
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
 
-def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
 
 def verify_api_key(api_key: str, conn) -> bool:
     """Проверяет валидность API ключа"""
     cur = conn.cursor()
     cur.execute(
-        "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
+        """SELECT id FROM api_keys
+        WHERE api_key = %s AND is_active = true
+          AND (expiry_date IS NULL OR expiry_date > NOW())""",
         (api_key,)
     )
     result = cur.fetchone()
     cur.close()
     return result is not None
 
+WAPPI_BALANCE_STRATEGIES = ('round_robin', 'least_in_flight')
+SUCCESS_RESPONSE_CODES = (200, 202)
+RESPONSE_BODY_POLICIES = ('all', 'errors', 'none')
+RATE_LIMIT_FIELDS = ('rate_limit', 'rate_burst', 'wappi_rate_limit', 'wappi_rate_burst')
+REMOVABLE_CONFIG_FIELDS = ('wappi_profiles', 'max_in_flight') + RATE_LIMIT_FIELDS
+
+def latency_percentile(latencies: List[int], quantile: float) -> Optional[int]:
+    """Перцентиль длительности последних попыток из provider_health.recent_latencies"""
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return ordered[max(math.ceil(quantile * len(ordered)) - 1, 0)]
+
+def positive_number(value: Any) -> bool:
+    """Положительное число (bool не считается числом)"""
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and value > 0
+
+def valid_wappi_profiles(profiles: Any) -> bool:
+    """Список профилей Wappi: у каждого profile_id и token, weight и лимиты - положительные числа"""
+    if not isinstance(profiles, list) or not profiles:
+        return False
+    for profile in profiles:
+        if not isinstance(profile, dict) or not profile.get('profile_id') or not profile.get('token'):
+            return False
+        for field in ('weight', 'rate_limit', 'rate_burst'):
+            value = profile.get(field)
+            if value is not None and not positive_number(value):
+                return False
+    return True
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Управляет настройками провайдеров
     
-    GET /api/providers - получить список провайдеров
+    GET /api/providers - получить список провайдеров (статус из сводки provider_health)
     GET /api/providers/config?provider_code=wappi - получить конфиг провайдера
     POST /api/providers/config - сохранить конфиг провайдера
         Body: {
             "provider_code": "whatsapp_business",
             "wappi_token": "...",
-            "wappi_profile_id": "..."
+            "wappi_profile_id": "...",
+            "wappi_profiles": [{"profile_id": "...", "token": "...", "weight": 1}] (опционально, вместо пары выше),
+            "wappi_balance": "round_robin|least_in_flight" (опционально),
+            "wappi_async": true (опционально, отправка через асинхронный endpoint Wappi),
+            "response_body_policy": "all|errors|none" (опционально, какие ответы провайдера хранить),
+            "rate_limit": 10, "rate_burst": 20 (опционально, сообщений в секунду для провайдера),
+            "wappi_rate_limit": 1, "wappi_rate_burst": 2 (опционально, то же для каждого профиля Wappi),
+            "max_in_flight": 4 (опционально, одновременных попыток доставки через провайдера)
         }
+        Переданные ключи дописываются в существующий конфиг, остальные сохраняются.
+        null в wappi_profiles, лимитах и max_in_flight удаляет ключ из конфига;
+        пара wappi_token/wappi_profile_id без wappi_profiles заменяет прежний список профилей.
     """
     method = event.get('httpMethod', 'GET')
     
@@ -50,6 +216,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
+    
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -127,17 +295,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         p.config, 
                         p.created_at, 
                         p.updated_at,
-                        da.status as last_attempt_status,
-                        da.response_code as last_response_code,
-                        da.attempted_at as last_attempt_at
+                        h.last_status as last_attempt_status,
+                        h.last_response_code as last_response_code,
+                        h.last_attempt_at as last_attempt_at,
+                        h.success_rate,
+                        h.recent_latencies
                     FROM providers p
-                    LEFT JOIN LATERAL (
-                        SELECT status, response_code, attempted_at
-                        FROM delivery_attempts
-                        WHERE provider = p.provider_code
-                        ORDER BY attempted_at DESC
-                        LIMIT 1
-                    ) da ON true
+                    LEFT JOIN provider_health h ON h.provider_code = p.provider_code
                     ORDER BY p.provider_name"""
                 )
                 providers = cur.fetchall()
@@ -154,7 +318,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         connection_status = 'not_configured'
                     elif not last_status:
                         connection_status = 'configured'
-                    elif last_status == 'success' and last_code == 200:
+                    elif last_status == 'success' and last_code in SUCCESS_RESPONSE_CODES:
                         connection_status = 'working'
                     else:
                         connection_status = 'error'
@@ -169,6 +333,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'last_attempt_status': last_status,
                         'last_response_code': last_code,
                         'last_attempt_at': p['last_attempt_at'].isoformat() if p['last_attempt_at'] else None,
+                        'success_rate': round(p['success_rate'], 4) if p['success_rate'] is not None else None,
+                        'latency_p95_ms': latency_percentile(p['recent_latencies'] or [], 0.95),
                         'created_at': p['created_at'].isoformat() if p['created_at'] else None,
                         'updated_at': p['updated_at'].isoformat() if p['updated_at'] else None
                     })
@@ -191,9 +357,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             provider_type = body_data.get('provider_type')
             wappi_token = body_data.get('wappi_token')
             wappi_profile_id = body_data.get('wappi_profile_id')
+            wappi_profiles = body_data.get('wappi_profiles')
+            wappi_balance = body_data.get('wappi_balance')
+            wappi_async = body_data.get('wappi_async')
+            response_body_policy = body_data.get('response_body_policy')
             postbox_access_key = body_data.get('postbox_access_key')
             postbox_secret_key = body_data.get('postbox_secret_key')
             postbox_from_email = body_data.get('postbox_from_email')
+            rate_limits = {field: body_data[field] for field in RATE_LIMIT_FIELDS if body_data.get(field) is not None}
+            max_in_flight = body_data.get('max_in_flight')
             
             if not provider_code:
                 conn.close()
@@ -204,11 +376,77 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            config = {}
+            if wappi_profiles is not None and not valid_wappi_profiles(wappi_profiles):
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid wappi_profiles'}),
+                    'isBase64Encoded': False
+                }
+            
+            if wappi_balance is not None and wappi_balance not in WAPPI_BALANCE_STRATEGIES:
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'error': 'Invalid wappi_balance',
+                        'allowed': list(WAPPI_BALANCE_STRATEGIES)
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            if response_body_policy is not None and response_body_policy not in RESPONSE_BODY_POLICIES:
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'error': 'Invalid response_body_policy',
+                        'allowed': list(RESPONSE_BODY_POLICIES)
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            for field, value in rate_limits.items():
+                if not positive_number(value):
+                    conn.close()
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': f'Invalid {field}'}),
+                        'isBase64Encoded': False
+                    }
+            
+            if max_in_flight is not None and (not positive_number(max_in_flight) or not isinstance(max_in_flight, int)):
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid max_in_flight'}),
+                    'isBase64Encoded': False
+                }
+            
+            removed = [field for field in REMOVABLE_CONFIG_FIELDS if field in body_data and body_data[field] is None]
+            if (wappi_token or wappi_profile_id) and 'wappi_profiles' not in body_data:
+                removed.append('wappi_profiles')
+            
+            config = dict(rate_limits)
+            if max_in_flight is not None:
+                config['max_in_flight'] = max_in_flight
             if wappi_token:
                 config['wappi_token'] = wappi_token
             if wappi_profile_id:
                 config['wappi_profile_id'] = wappi_profile_id
+            if wappi_profiles:
+                config['wappi_profiles'] = wappi_profiles
+            if wappi_balance:
+                config['wappi_balance'] = wappi_balance
+            if 'wappi_async' in body_data:
+                config['wappi_async'] = bool(wappi_async)
+            if response_body_policy:
+                config['response_body_policy'] = response_body_policy
             if postbox_access_key:
                 config['postbox_access_key'] = postbox_access_key
             if postbox_secret_key:
@@ -227,10 +465,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             if existing:
                 cur.execute(
                     """UPDATE providers 
-                    SET config = %s, updated_at = NOW(), is_active = true
+                    SET config = (COALESCE(config, '{}'::jsonb) - %s::text[]) || %s::jsonb,
+                        updated_at = NOW(), is_active = true
                     WHERE provider_code = %s
                     RETURNING provider_code, provider_name, is_active""",
-                    (json.dumps(config), provider_code)
+                    (removed, json.dumps(config), provider_code)
                 )
             else:
                 if not provider_name:
@@ -340,4 +579,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
@@ -1,139 +1,1010 @@
+import hashlib
+import hmac
+import asyncio
+import bisect
+import gzip
 import json
+import math
 import os
+import random
+import threading
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import requests
-from datetime import datetime
-from typing import Dict, Any, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, Optional, Tuple
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
 
-def get_db_connection():
-    """Создает подключение к базе данных"""
-    return psycopg2.connect(
-        os.environ['DATABASE_URL'],
-        cursor_factory=RealDictCursor
-    )
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
 
-def verify_api_key(api_key: str, conn) -> bool:
-    """Проверяет валидность API ключа"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id FROM api_keys WHERE api_key = %s AND is_active = true",
-        (api_key,)
-    )
-    result = cur.fetchone()
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
     
-    if result:
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
+
+API_KEY_CACHE_TTL = float(os.environ.get('API_KEY_CACHE_TTL', '60'))
+API_KEY_TOUCH_INTERVAL = float(os.environ.get('API_KEY_TOUCH_INTERVAL', '60'))
+API_KEY_INVALIDATION_POLL = float(os.environ.get('API_KEY_INVALIDATION_POLL', '5'))
+
+class ApiKeyCache:
+    """TTL-кэш проверенных API ключей с отложенной записью last_used_at
+    
+    - запись живет не дольше ttl и не дольше expiry_date ключа
+    - версия из cache_invalidations опрашивается раз в invalidation_poll секунд,
+      при ее изменении (перевыпуск/удаление ключа) кэш сбрасывается
+    - last_used_at пишется одним UPDATE не чаще раза в touch_interval секунд
+    """
+    
+    def __init__(self, ttl: float, touch_interval: float, invalidation_poll: float):
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.invalidation_poll = invalidation_poll
+        self._entries: Dict[str, Tuple[int, float]] = {}
+        self._touched: set = set()
+        self._flushed_at = 0.0
+        self._version: Optional[int] = None
+        self._polled_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _sync_version(self, conn) -> None:
+        now = time.monotonic()
+        if now - self._polled_at < self.invalidation_poll:
+            return
+        
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM cache_invalidations WHERE cache_name = 'api_keys'")
+        result = cur.fetchone()
+        cur.close()
+        version = result['version'] if result else 0
+        
+        with self._lock:
+            self._polled_at = now
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+    
+    def lookup(self, api_key: str, conn) -> Optional[int]:
+        """Возвращает id действующего ключа или None"""
+        self._sync_version(conn)
+        now = time.monotonic()
+        
+        with self._lock:
+            entry = self._entries.get(api_key)
+        if entry and entry[1] > now:
+            return entry[0]
+        
+        cur = conn.cursor()
         cur.execute(
-            "UPDATE api_keys SET last_used_at = NOW() WHERE api_key = %s",
+            """SELECT id, EXTRACT(EPOCH FROM (expiry_date - NOW())) AS expires_in
+            FROM api_keys
+            WHERE api_key = %s AND is_active = true
+              AND (expiry_date IS NULL OR expiry_date > NOW())""",
             (api_key,)
         )
+        result = cur.fetchone()
+        cur.close()
+        
+        with self._lock:
+            if not result:
+                self._entries.pop(api_key, None)
+                return None
+            
+            ttl = self.ttl
+            if result['expires_in'] is not None:
+                ttl = min(ttl, float(result['expires_in']))
+            self._entries[api_key] = (result['id'], now + ttl)
+        
+        return result['id']
+    
+    def touch(self, key_id: int, conn) -> None:
+        """Отмечает использование ключа и при необходимости сбрасывает буфер в БД"""
+        now = time.monotonic()
+        with self._lock:
+            self._touched.add(key_id)
+            if now - self._flushed_at < self.touch_interval:
+                return
+            key_ids = list(self._touched)
+            self._touched.clear()
+            self._flushed_at = now
+        
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE api_keys SET last_used_at = NOW() WHERE id = ANY(%s)",
+            (key_ids,)
+        )
         conn.commit()
+        cur.close()
+
+_api_key_cache = ApiKeyCache(API_KEY_CACHE_TTL, API_KEY_TOUCH_INTERVAL, API_KEY_INVALIDATION_POLL)
+
+def verify_api_key(api_key: str, conn) -> Optional[int]:
+    """Проверяет API ключ (через кэш, last_used_at пишется отложенно), возвращает его id или None"""
+    key_id = _api_key_cache.lookup(api_key, conn)
+    if key_id is None:
+        return None
     
-    cur.close()
-    return result is not None
+    _api_key_cache.touch(key_id, conn)
+    return key_id
 
-def check_provider_active(provider: str, conn) -> Tuple[bool, Optional[str]]:
-    """Проверяет активность провайдера"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT is_active, provider_name FROM providers WHERE provider_code = %s",
-        (provider,)
-    )
-    result = cur.fetchone()
-    cur.close()
+# >>> общее ядро доставки (копия в retry/index.py, проверка: backend/check_shared_core.py)
+PROVIDER_CACHE_POLL = float(os.environ.get('PROVIDER_CACHE_POLL', '5'))
+
+@dataclass(frozen=True)
+class ProviderRecord:
+    """Неизменяемая запись провайдера из таблицы providers"""
+    provider_code: str
+    provider_name: str
+    provider_type: str
+    is_active: bool
+    config: Mapping[str, Any]
+    updated_at: Optional[datetime]
     
-    if not result:
-        return False, None
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> 'ProviderRecord':
+        return cls(
+            provider_code=row['provider_code'],
+            provider_name=row['provider_name'],
+            provider_type=row['provider_type'],
+            is_active=bool(row['is_active']),
+            config=MappingProxyType(dict(row['config'] or {})),
+            updated_at=row['updated_at']
+        )
+
+class ProviderCache:
+    """Кэш записей провайдеров в памяти процесса
+    
+    Раз в poll_interval секунд сверяет MAX(updated_at) и число строк в providers;
+    если они изменились (сохранение конфига, добавление или удаление), кэш сбрасывается.
+    """
     
-    return result['is_active'], result['provider_name']
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._records: Dict[str, ProviderRecord] = {}
+        self._stamp: Optional[Tuple[Any, int]] = None
+        self._polled_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _sync(self, conn) -> None:
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval:
+            return
+        
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(updated_at) AS updated_at, COUNT(*) AS total FROM providers")
+        result = cur.fetchone()
+        cur.close()
+        stamp = (result['updated_at'], result['total'])
+        
+        with self._lock:
+            self._polled_at = now
+            if stamp != self._stamp:
+                self._records.clear()
+                self._stamp = stamp
+    
+    def get(self, provider_code: str, conn) -> Optional[ProviderRecord]:
+        self._sync(conn)
+        
+        with self._lock:
+            record = self._records.get(provider_code)
+        if record:
+            return record
+        
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT provider_code, provider_name, provider_type, is_active, config, updated_at
+            FROM providers WHERE provider_code = %s""",
+            (provider_code,)
+        )
+        result = cur.fetchone()
+        cur.close()
+        
+        if not result:
+            return None
+        
+        record = ProviderRecord.from_row(result)
+        with self._lock:
+            self._records[provider_code] = record
+        return record
+
+_provider_cache = ProviderCache(PROVIDER_CACHE_POLL)
+
+def get_provider(provider: str, conn) -> Optional[ProviderRecord]:
+    """Возвращает запись провайдера (из кэша процесса или из БД)"""
+    return _provider_cache.get(provider, conn)
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_POLL_INTERVAL = float(os.environ.get('CIRCUIT_POLL_INTERVAL', '5'))
+CIRCUIT_OPEN_ERROR = 'Provider circuit open'
+
+class CircuitBreaker:
+    """Размыкатель цепи по provider_code
+    
+    closed - попытки идут как обычно; после failure_threshold неудач подряд
+    цепь размыкается (open) на open_seconds, и к провайдеру не обращаются.
+    Затем half_open: пропускается одна пробная попытка, успех замыкает цепь,
+    неудача размыкает снова. Переходы пишутся в provider_circuits вместе с
+    DeliveryUnitOfWork.commit(), переходы других экземпляров подтягиваются
+    через sync() раз в poll_interval секунд.
+    """
+    
+    def __init__(self, failure_threshold: int, open_seconds: float, poll_interval: float):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.poll_interval = poll_interval
+        self._states: Dict[str, str] = {}
+        self._open_until: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._probing: set = set()
+        self._changed: set = set()
+        self._polled_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _state(self, provider_code: str) -> str:
+        state = self._states.get(provider_code, 'closed')
+        if state == 'open' and time.monotonic() >= self._open_until[provider_code]:
+            state = self._states[provider_code] = 'half_open'
+        return state
+    
+    def _switch(self, provider_code: str, state: str) -> None:
+        self._states[provider_code] = state
+        self._open_until[provider_code] = time.monotonic() + self.open_seconds if state == 'open' else 0.0
+        self._changed.add(provider_code)
+        print(f"[CIRCUIT] {provider_code} -> {state}")
+    
+    def state(self, provider_code: str) -> str:
+        with self._lock:
+            return self._state(provider_code)
+    
+    def release(self, provider_code: str) -> None:
+        """Освобождает место пробной попытки, если задание так и не было отправлено"""
+        with self._lock:
+            self._probing.discard(provider_code)
+    
+    def allow(self, provider_code: str) -> bool:
+        """Можно ли обратиться к провайдеру; в half_open занимает место пробной попытки"""
+        with self._lock:
+            state = self._state(provider_code)
+            if state == 'closed':
+                return True
+            if state == 'half_open' and provider_code not in self._probing:
+                self._probing.add(provider_code)
+                return True
+            return False
+    
+    def retry_after(self, provider_code: str) -> float:
+        """Через сколько секунд стоит снова обратиться к провайдеру"""
+        with self._lock:
+            if self._state(provider_code) == 'closed':
+                return 0.0
+            return max(self._open_until[provider_code] - time.monotonic(), self.poll_interval)
+    
+    def record(self, provider_code: str, healthy: bool) -> None:
+        """Учитывает исход попытки: healthy - провайдер ответил, а не упал или перегружен"""
+        with self._lock:
+            self._probing.discard(provider_code)
+            state = self._state(provider_code)
+            
+            if healthy:
+                self._failures[provider_code] = 0
+                if state != 'closed':
+                    self._switch(provider_code, 'closed')
+                return
+            
+            self._failures[provider_code] = self._failures.get(provider_code, 0) + 1
+            if state == 'half_open' or (state == 'closed' and self._failures[provider_code] >= self.failure_threshold):
+                self._failures[provider_code] = 0
+                self._switch(provider_code, 'open')
+    
+    def flush_statements(self, cur) -> List[str]:
+        """SQL записи накопленных переходов в provider_circuits"""
+        with self._lock:
+            now = time.monotonic()
+            rows = [
+                (code, self._states[code], round(max(self._open_until[code] - now, 0), 3))
+                for code in self._changed
+            ]
+            self._changed.clear()
+        
+        if not rows:
+            return []
+        
+        values = ', '.join(
+            cur.mogrify("(%s, %s, NOW() + %s * INTERVAL '1 second', NOW())", row).decode()
+            for row in rows
+        )
+        return [
+            f"""INSERT INTO provider_circuits (provider_code, state, open_until, updated_at)
+            VALUES {values}
+            ON CONFLICT (provider_code) DO UPDATE
+            SET state = EXCLUDED.state, open_until = EXCLUDED.open_until, updated_at = EXCLUDED.updated_at"""
+        ]
+    
+    def sync(self, conn) -> None:
+        """Подтягивает состояние цепей, записанное другими экземплярами"""
+        now = time.monotonic()
+        if now - self._polled_at < self.poll_interval:
+            return
+        
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT provider_code, state,
+                   GREATEST(EXTRACT(EPOCH FROM open_until - NOW()), 0) AS open_for
+            FROM provider_circuits"""
+        )
+        rows = cur.fetchall()
+        cur.close()
+        
+        with self._lock:
+            self._polled_at = now
+            for row in rows:
+                code = row['provider_code']
+                if code in self._changed or self._states.get(code, 'closed') == row['state']:
+                    continue
+                self._states[code] = row['state']
+                self._open_until[code] = now + float(row['open_for'] or 0) if row['state'] == 'open' else 0.0
+
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_POLL_INTERVAL)
+
+MESSAGE_MAX_ATTEMPTS = int(os.environ.get('MESSAGE_MAX_ATTEMPTS', '6'))
+DELIVERY_LEASE_SECONDS = int(os.environ.get('DELIVERY_LEASE_SECONDS', '300'))
+PROVIDER_HEALTH_LATENCIES = int(os.environ.get('PROVIDER_HEALTH_LATENCIES', '20'))
+PROVIDER_HEALTH_ALPHA = float(os.environ.get('PROVIDER_HEALTH_ALPHA', '0.05'))
+STATS_BUCKET_SIZES = ('minute', 'hour')
+STATS_LATENCY_BOUNDS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# <<< общее ядро доставки
+
+def initial_attempt_delay(status: str) -> int:
+    """Через сколько секунд новое сообщение станет доступно планировщику
+    
+    queued разбирает планировщик сразу, pending доставляется в запросе,
+    поэтому до истечения аренды планировщик его не трогает.
+    """
+    return 0 if status == 'queued' else DELIVERY_LEASE_SECONDS
+
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', '86400'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+def release_expired_idempotency_keys(cur, api_key_id: int, keys: List[str]) -> None:
+    """Освобождает ключи идемпотентности, у которых истек срок хранения"""
+    cur.execute(
+        """UPDATE messages SET idempotency_key = NULL
+        WHERE api_key_id = %s AND idempotency_key = ANY(%s) AND idempotency_expires_at <= NOW()""",
+        (api_key_id, keys)
+    )
+
+def find_idempotent_messages(cur, api_key_id: int, keys: List[str]) -> Dict[str, Dict]:
+    """Сообщения, уже принятые с этими ключами идемпотентности, по ключу"""
+    cur.execute(
+        """SELECT idempotency_key, message_id, provider, status, attempts, last_error
+        FROM messages WHERE api_key_id = %s AND idempotency_key = ANY(%s)""",
+        (api_key_id, keys)
+    )
+    return {row['idempotency_key']: row for row in cur.fetchall()}
 
 def save_message(message_id: str, provider: str, recipient: str, 
-                message_text: str, metadata: Dict, conn) -> None:
-    """Сохраняет сообщение в БД"""
+                message_text: str, metadata: Dict, conn,
+                status: str = 'pending', delivery_options: Optional[Dict] = None,
+                api_key_id: Optional[int] = None, idempotency_key: Optional[str] = None) -> Optional[Dict]:
+    """Сохраняет сообщение в БД
+    
+    Если сообщение с тем же idempotency_key этого API ключа уже принято
+    и срок хранения ключа не истек, новое не сохраняется и возвращается прежнее.
+    """
     cur = conn.cursor()
+    if idempotency_key:
+        release_expired_idempotency_keys(cur, api_key_id, [idempotency_key])
+    
     cur.execute(
         """INSERT INTO messages 
-        (message_id, provider, recipient, message_text, metadata, status, attempts, created_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())""",
-        (message_id, provider, recipient, message_text, json.dumps(metadata), 'pending', 0)
+        (message_id, provider, recipient, message_text, metadata, delivery_options,
+         status, attempts, max_attempts, next_attempt_at, created_at,
+         api_key_id, idempotency_key, idempotency_expires_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW() + %s * INTERVAL '1 second', NOW(),
+                %s, %s, CASE WHEN %s IS NOT NULL THEN NOW() + %s * INTERVAL '1 second' END)
+        ON CONFLICT (api_key_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+        RETURNING message_id""",
+        (message_id, provider, recipient, message_text, json.dumps(metadata),
+         json.dumps(delivery_options or {}), status, 0, MESSAGE_MAX_ATTEMPTS,
+         initial_attempt_delay(status), api_key_id, idempotency_key, idempotency_key, IDEMPOTENCY_KEY_TTL)
     )
+    
+    existing = None
+    if cur.fetchone() is None:
+        existing = find_idempotent_messages(cur, api_key_id, [idempotency_key]).get(idempotency_key)
     conn.commit()
     cur.close()
+    return existing
 
-def log_attempt(message_id: str, attempt_number: int, provider: str, 
-               status: str, response_code: Optional[int], response_body: str,
-               error_message: Optional[str], duration_ms: int, conn) -> None:
-    """Логирует попытку доставки"""
+def save_messages(messages: List[Dict], conn, status: str = 'pending',
+                  api_key_id: Optional[int] = None) -> Dict[str, Dict]:
+    """Сохраняет пачку сообщений одним многострочным INSERT
+    
+    Сообщения с уже принятым idempotency_key не сохраняются; возвращаются
+    прежние сообщения по ключу.
+    """
     cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO delivery_attempts 
-        (message_id, attempt_number, provider, status, response_code, 
-         response_body, error_message, duration_ms, attempted_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())""",
-        (message_id, attempt_number, provider, status, response_code, 
-         response_body, error_message, duration_ms)
+    keys = [m['idempotency_key'] for m in messages if m.get('idempotency_key')]
+    if keys:
+        release_expired_idempotency_keys(cur, api_key_id, keys)
+    
+    inserted = execute_values(
+        cur,
+        """INSERT INTO messages 
+        (message_id, provider, recipient, message_text, metadata, delivery_options,
+         status, attempts, max_attempts, next_attempt_at, created_at,
+         api_key_id, idempotency_key, idempotency_expires_at)
+        VALUES %s
+        ON CONFLICT (api_key_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+        RETURNING message_id""",
+        [
+            (m['message_id'], m['provider'], m['recipient'], m['message_text'],
+             json.dumps(m['metadata']), json.dumps(m['delivery_options']), status,
+             MESSAGE_MAX_ATTEMPTS, initial_attempt_delay(status),
+             api_key_id, m.get('idempotency_key'), m.get('idempotency_key'), IDEMPOTENCY_KEY_TTL)
+            for m in messages
+        ],
+        template=(
+            "(%s, %s, %s, %s, %s, %s, %s, 0, %s, NOW() + %s * INTERVAL '1 second', NOW(), "
+            "%s, %s, CASE WHEN %s IS NOT NULL THEN NOW() + %s * INTERVAL '1 second' END)"
+        ),
+        page_size=len(messages),
+        fetch=True
     )
+    
+    existing: Dict[str, Dict] = {}
+    if len(inserted) < len(messages):
+        existing = find_idempotent_messages(cur, api_key_id, keys)
     conn.commit()
     cur.close()
+    return existing
 
-def update_message_status(message_id: str, status: str, attempts: int,
-                         last_error: Optional[str], conn) -> None:
-    """Обновляет статус сообщения"""
-    cur = conn.cursor()
+# >>> общее ядро доставки (копия в retry/index.py, проверка: backend/check_shared_core.py)
+class DeliveryUnitOfWork:
+    """Накапливает попытки доставки и итоговый статус сообщения
     
-    if status == 'delivered':
-        cur.execute(
-            """UPDATE messages 
-            SET status = %s, attempts = %s, last_error = %s, 
-                last_attempt_at = NOW(), completed_at = NOW()
-            WHERE message_id = %s""",
-            (status, attempts, last_error, message_id)
-        )
-    else:
-        cur.execute(
-            """UPDATE messages 
-            SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW()
-            WHERE message_id = %s""",
-            (status, attempts, last_error, message_id)
-        )
+    commit() пишет все накопленное одним запросом и одной транзакцией вместо
+    отдельного INSERT/UPDATE и commit на каждую попытку. В той же транзакции
+    обновляются сводка provider_health, которую читает список провайдеров,
+    и корзины статистики delivery_stats_rollups.
+    Сама запись сообщения сохраняется раньше (save_message), до обращения к провайдеру.
+    """
     
-    conn.commit()
-    cur.close()
+    def __init__(self, conn):
+        self.conn = conn
+        self._attempts: List[Tuple] = []
+        self._statuses: List[Tuple] = []
+    
+    def log_attempt(self, message_id: str, attempt_number: int, provider: str,
+                    status: str, response_code: Optional[int], response_body: Optional[str],
+                    error_message: Optional[str], duration_ms: int,
+                    response_body_gz: Optional[bytes] = None, provider_message_id: Optional[str] = None,
+                    error_code: Optional[str] = None) -> None:
+        """Логирует попытку доставки (запишется при commit)
+        
+        response_body - начало ответа провайдера, response_body_gz - весь ответ в gzip.
+        """
+        self._attempts.append((
+            message_id, attempt_number, provider, status, response_code,
+            response_body, error_message, duration_ms,
+            response_body_gz, provider_message_id, error_code, time.monotonic()
+        ))
+    
+    def update_message_status(self, message_id: str, status: str, attempts: int,
+                              last_error: Optional[str], retry_in: Optional[float] = None,
+                              provider_message_id: Optional[str] = None,
+                              provider_profile_id: Optional[str] = None,
+                              provider: Optional[str] = None) -> None:
+        """Обновляет статус сообщения (запишется при commit)
+        
+        retry_in - через сколько секунд планировщик повторит отправку
+        (для status sent - проверит статус доставки у провайдера),
+        None - автоматических повторов больше не будет.
+        provider - канал маршрута, через который прошла последняя попытка.
+        """
+        self._statuses.append((
+            status, attempts, last_error, status, retry_in,
+            provider_message_id, provider_profile_id, provider, message_id
+        ))
+    
+    def _provider_health_statements(self, cur, now: float) -> List[str]:
+        """Upsert provider_health по попыткам пачки, по одной строке на провайдера
+        
+        success_rate сдвигается к доле успехов пачки так же, как сдвинулось бы
+        экспоненциальное среднее после n попыток по одной.
+        """
+        by_provider: Dict[str, List[tuple]] = {}
+        for row in self._attempts:
+            by_provider.setdefault(row[2], []).append(row)
+        
+        statements = []
+        for provider_code in sorted(by_provider):
+            rows = sorted(by_provider[provider_code], key=lambda row: row[-1])
+            last = rows[-1]
+            successes = sum(1 for row in rows if row[3] == 'success')
+            latencies = [row[7] for row in rows if row[7] is not None][-PROVIDER_HEALTH_LATENCIES:]
+            statements.append(cur.mogrify(
+                """INSERT INTO provider_health
+                (provider_code, last_status, last_response_code, last_attempt_at,
+                 success_rate, attempts_total, recent_latencies, updated_at)
+                VALUES (%s, %s, %s, NOW() - %s * INTERVAL '1 second', %s, %s, %s::INT[], NOW())
+                ON CONFLICT (provider_code) DO UPDATE SET
+                    last_status = EXCLUDED.last_status,
+                    last_response_code = EXCLUDED.last_response_code,
+                    last_attempt_at = EXCLUDED.last_attempt_at,
+                    success_rate = CASE WHEN provider_health.success_rate IS NULL THEN EXCLUDED.success_rate
+                        ELSE provider_health.success_rate * %s + EXCLUDED.success_rate * (1 - %s) END,
+                    attempts_total = provider_health.attempts_total + EXCLUDED.attempts_total,
+                    recent_latencies = (provider_health.recent_latencies || EXCLUDED.recent_latencies)[
+                        GREATEST(cardinality(provider_health.recent_latencies)
+                                 + cardinality(EXCLUDED.recent_latencies) - %s + 1, 1):],
+                    updated_at = NOW()""",
+                (
+                    provider_code, last[3], last[4], round(now - last[-1], 3),
+                    successes / len(rows), len(rows), latencies,
+                    (1 - PROVIDER_HEALTH_ALPHA) ** len(rows), (1 - PROVIDER_HEALTH_ALPHA) ** len(rows),
+                    PROVIDER_HEALTH_LATENCIES
+                )
+            ).decode())
+        return statements
+    
+    def _stats_rollup_statements(self, cur, now: float) -> List[str]:
+        """Upsert delivery_stats_rollups: попытки пачки добавляются в минутные и часовые корзины
+        
+        Попытки группируются по провайдеру и минуте, в которую они сделаны;
+        начало корзины считается по часам БД, как attempted_at.
+        """
+        wall_now = time.time()
+        groups: Dict[Tuple[str, int], List[tuple]] = {}
+        for row in self._attempts:
+            minute = int((wall_now - (now - row[-1])) // 60)
+            groups.setdefault((row[2], minute), []).append(row)
+        
+        statements = []
+        for provider_code, minute in sorted(groups):
+            rows = groups[(provider_code, minute)]
+            durations = [row[7] or 0 for row in rows]
+            histogram = [0] * (len(STATS_LATENCY_BOUNDS) + 1)
+            for duration in durations:
+                histogram[bisect.bisect_right(STATS_LATENCY_BOUNDS, duration)] += 1
+            
+            for bucket_size in STATS_BUCKET_SIZES:
+                statements.append(cur.mogrify(
+                    """INSERT INTO delivery_stats_rollups
+                    (bucket_size, bucket_start, provider_code, attempts, successes,
+                     duration_ms_sum, duration_ms_max, latency_buckets)
+                    VALUES (%s, date_trunc(%s, NOW() - %s * INTERVAL '1 second'), %s, %s, %s, %s, %s, %s::INT[])
+                    ON CONFLICT (bucket_size, bucket_start, provider_code) DO UPDATE SET
+                        attempts = delivery_stats_rollups.attempts + EXCLUDED.attempts,
+                        successes = delivery_stats_rollups.successes + EXCLUDED.successes,
+                        duration_ms_sum = delivery_stats_rollups.duration_ms_sum + EXCLUDED.duration_ms_sum,
+                        duration_ms_max = GREATEST(delivery_stats_rollups.duration_ms_max, EXCLUDED.duration_ms_max),
+                        latency_buckets = ARRAY(
+                            SELECT existing + added
+                            FROM unnest(delivery_stats_rollups.latency_buckets, EXCLUDED.latency_buckets)
+                                WITH ORDINALITY AS buckets(existing, added, ordinal)
+                            ORDER BY ordinal
+                        )""",
+                    (
+                        bucket_size, bucket_size, round(now - max(row[-1] for row in rows), 3), provider_code,
+                        len(rows), sum(1 for row in rows if row[3] == 'success'),
+                        sum(durations), max(durations), histogram
+                    )
+                ).decode())
+        return statements
+    
+    def commit(self) -> None:
+        cur = self.conn.cursor()
+        now = time.monotonic()
+        statements = []
+        
+        if self._attempts:
+            values = ', '.join(
+                cur.mogrify(
+                    "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW() - %s * INTERVAL '1 second')",
+                    row[:-1] + (round(now - row[-1], 3),)
+                ).decode()
+                for row in self._attempts
+            )
+            statements.append(
+                f"""INSERT INTO delivery_attempts 
+                (message_id, attempt_number, provider, status, response_code, 
+                 response_body, error_message, duration_ms,
+                 response_body_gz, provider_message_id, error_code, attempted_at)
+                VALUES {values}"""
+            )
+            statements.extend(self._provider_health_statements(cur, now))
+            statements.extend(self._stats_rollup_statements(cur, now))
+        
+        for message_status in self._statuses:
+            statements.append(cur.mogrify(
+                """UPDATE messages 
+                SET status = %s, attempts = %s, last_error = %s, last_attempt_at = NOW(),
+                    completed_at = CASE WHEN %s = 'delivered' THEN NOW() ELSE completed_at END,
+                    next_attempt_at = NOW() + %s * INTERVAL '1 second',
+                    provider_message_id = COALESCE(%s, provider_message_id),
+                    provider_profile_id = COALESCE(%s, provider_profile_id),
+                    provider = COALESCE(%s, provider)
+                WHERE message_id = %s""",
+                message_status
+            ).decode())
+        
+        statements.extend(circuit_breaker.flush_statements(cur))
+        
+        if statements:
+            cur.execute(';\n'.join(statements))
+        self.conn.commit()
+        cur.close()
+        
+        self._attempts = []
+        self._statuses = []
 
-def get_wappi_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает Wappi credentials и тип провайдера из конфига"""
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT config, provider_type FROM providers WHERE provider_code = %s",
-        (provider,)
-    )
-    result = cur.fetchone()
-    cur.close()
+WAPPI_HOST = 'wappi.pro'
+POSTBOX_HOST = 'postbox.cloud.yandex.net'
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '2'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '50'))
+HTTP_CONNECT_RETRIES = int(os.environ.get('HTTP_CONNECT_RETRIES', '2'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUTS = {
+    WAPPI_HOST: float(os.environ.get('WAPPI_TIMEOUT', '10')),
+    POSTBOX_HOST: float(os.environ.get('POSTBOX_TIMEOUT', '30'))
+}
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter с таймаутом по умолчанию для всех запросов сессии"""
     
-    if not result or not result['config']:
-        return None, None, None
+    def __init__(self, *args, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
     
-    config = result['config']
-    return config.get('wappi_token'), config.get('wappi_profile_id'), result['provider_type']
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+_http_sessions: Dict[str, requests.Session] = {}
+_http_sessions_lock = threading.Lock()
 
-def send_via_wappi(recipient: str, message: str, provider: str, conn) -> Tuple[int, str]:
-    """Отправляет сообщение через Wappi API"""
+def get_http_session(host: str) -> requests.Session:
+    """Возвращает keep-alive сессию для хоста провайдера, общую для теплых вызовов
+    
+    Повторяются только ошибки установки соединения: запрос до провайдера
+    еще не дошел, поэтому повтор POST не приведет к дублю сообщения.
+    """
+    session = _http_sessions.get(host)
+    if session is not None:
+        return session
+    
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            adapter = TimeoutHTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                max_retries=Retry(
+                    total=HTTP_CONNECT_RETRIES,
+                    connect=HTTP_CONNECT_RETRIES,
+                    read=False,
+                    status=0,
+                    backoff_factor=0.2
+                ),
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUTS.get(host, 10))
+            )
+            session = requests.Session()
+            session.mount(f'https://{host}/', adapter)
+            _http_sessions[host] = session
+    return session
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата) в секунды ожидания"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+RESPONSE_READ_MAX_BYTES = int(os.environ.get('RESPONSE_READ_MAX_BYTES', '65536'))
+
+def read_response_body(response: requests.Response, max_bytes: int = RESPONSE_READ_MAX_BYTES) -> str:
+    """Читает тело ответа потоком (запрос с stream=True), не больше max_bytes байт
+    
+    Остаток большого ответа не скачивается: соединение закрывается, а не
+    возвращается в пул сессии.
+    """
+    chunks: List[bytes] = []
+    size = 0
     try:
-        wappi_token, wappi_profile_id, provider_type = get_wappi_credentials(provider, conn)
+        for chunk in response.iter_content(chunk_size=8192):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                break
+    finally:
+        response.close()
+    return b''.join(chunks)[:max_bytes].decode(response.encoding or 'utf-8', errors='replace')
+
+WAPPI_ENDPOINTS = {
+    'max': f'https://{WAPPI_HOST}/maxapi',
+    'telegram_bot': f'https://{WAPPI_HOST}/tapi',
+    'whatsapp_business': f'https://{WAPPI_HOST}/api',
+    'wappi': f'https://{WAPPI_HOST}/api'
+}
+SENT_STATUS_CODE = 202
+SENT_RECONCILE_DELAY = float(os.environ.get('SENT_RECONCILE_DELAY', '30'))
+
+WAPPI_PROFILE_FAILURE_THRESHOLD = int(os.environ.get('WAPPI_PROFILE_FAILURE_THRESHOLD', '3'))
+WAPPI_PROFILE_EJECT_SECONDS = float(os.environ.get('WAPPI_PROFILE_EJECT_SECONDS', '60'))
+
+@dataclass(frozen=True)
+class WappiProfile:
+    """Профиль Wappi, через который провайдер отправляет сообщения"""
+    profile_id: str
+    token: str
+    weight: int = 1
+    rate_limit: float = 0.0
+    rate_burst: float = 0.0
+
+def wappi_profiles(provider: ProviderRecord) -> Tuple[WappiProfile, ...]:
+    """Профили провайдера: config.wappi_profiles или одна пара wappi_token/wappi_profile_id
+    
+    Элемент wappi_profiles: {"profile_id", "token", "weight", "rate_limit", "rate_burst"};
+    без rate_limit профиль берет wappi_rate_limit/wappi_rate_burst провайдера.
+    """
+    config = provider.config
+    items = config.get('wappi_profiles') or [
+        {'profile_id': config.get('wappi_profile_id'), 'token': config.get('wappi_token')}
+    ]
+    
+    profiles = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get('profile_id') or not item.get('token'):
+            continue
+        rate = float(item.get('rate_limit') or config.get('wappi_rate_limit') or 0)
+        profiles.append(WappiProfile(
+            profile_id=str(item['profile_id']),
+            token=item['token'],
+            weight=max(int(item.get('weight') or 1), 1),
+            rate_limit=rate,
+            rate_burst=float(item.get('rate_burst') or config.get('wappi_rate_burst') or rate)
+        ))
+    return tuple(profiles)
+
+class WappiBalancer:
+    """Распределение отправок провайдера Wappi между его профилями
+    
+    Стратегия задается config.wappi_balance: round_robin (по умолчанию) -
+    плавный взвешенный round-robin по weight, least_in_flight - профиль
+    с наименьшим числом отправок в работе на единицу веса.
+    Профиль, failure_threshold раз подряд ответивший временной ошибкой,
+    исключается из ротации на eject_seconds; после возвращения первая же
+    ошибка исключает его снова. Последний профиль в ротации не исключается:
+    отказ всего провайдера обрабатывает CircuitBreaker. Состояние хранится
+    в памяти экземпляра функции.
+    """
+    
+    def __init__(self, failure_threshold: int, eject_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self._current_weight: Dict[Tuple[str, str], int] = {}
+        self._in_flight: Dict[Tuple[str, str], int] = {}
+        self._failures: Dict[Tuple[str, str], int] = {}
+        self._ejected_until: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+    
+    def _in_rotation(self, provider_code: str, profiles: Tuple[WappiProfile, ...], now: float) -> List[WappiProfile]:
+        return [
+            profile for profile in profiles
+            if self._ejected_until.get((provider_code, profile.profile_id), 0.0) <= now
+        ]
+    
+    def acquire(self, provider: ProviderRecord) -> Optional[WappiProfile]:
+        """Выбирает профиль для отправки и учитывает ее в работе, None - профилей нет"""
+        profiles = wappi_profiles(provider)
+        if not profiles:
+            return None
         
-        if not wappi_token or not wappi_profile_id:
-            return 500, json.dumps({"error": "Wappi credentials not configured"})
+        code = provider.provider_code
+        with self._lock:
+            candidates = self._in_rotation(code, profiles, time.monotonic()) or list(profiles)
+            
+            if provider.config.get('wappi_balance') == 'least_in_flight':
+                chosen = min(
+                    candidates,
+                    key=lambda profile: self._in_flight.get((code, profile.profile_id), 0) / profile.weight
+                )
+            else:
+                total = sum(profile.weight for profile in candidates)
+                for profile in candidates:
+                    key = (code, profile.profile_id)
+                    self._current_weight[key] = self._current_weight.get(key, 0) + profile.weight
+                chosen = max(candidates, key=lambda profile: self._current_weight[(code, profile.profile_id)])
+                self._current_weight[(code, chosen.profile_id)] -= total
+            
+            key = (code, chosen.profile_id)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        return chosen
+    
+    def release(self, provider: ProviderRecord, profile: WappiProfile, healthy: Optional[bool] = None) -> None:
+        """Завершает отправку через профиль; healthy = None - отправки не было"""
+        code = provider.provider_code
+        key = (code, profile.profile_id)
+        with self._lock:
+            self._in_flight[key] = max(self._in_flight.get(key, 0) - 1, 0)
+            if healthy is None:
+                return
+            if healthy:
+                self._failures[key] = 0
+                return
+            
+            self._failures[key] = self._failures.get(key, 0) + 1
+            now = time.monotonic()
+            if self._failures[key] < self.failure_threshold or self._ejected_until.get(key, 0.0) > now:
+                return
+            if len(self._in_rotation(code, wappi_profiles(provider), now)) <= 1:
+                return
+            
+            self._ejected_until[key] = now + self.eject_seconds
+            self._failures[key] = self.failure_threshold - 1
+        print(f"[WAPPI] Profile {profile.profile_id} of {code} ejected for {self.eject_seconds:.0f}s")
+
+wappi_balancer = WappiBalancer(WAPPI_PROFILE_FAILURE_THRESHOLD, WAPPI_PROFILE_EJECT_SECONDS)
+
+def send_via_wappi(recipient: str, message: str, provider: ProviderRecord,
+                   profile: Optional[WappiProfile] = None) -> Tuple[int, str, Optional[float]]:
+    """Отправляет сообщение через Wappi API профилем profile (по умолчанию - первым профилем провайдера)
+    
+    С config.wappi_async = true используется асинхронный endpoint: Wappi только
+    принимает сообщение, и успешная отправка возвращает SENT_STATUS_CODE (202)
+    вместо 200. Итоговый статус доставки потом сверяет планировщик.
+    """
+    try:
+        if profile is None:
+            profile = next(iter(wappi_profiles(provider)), None)
+        wappi_token = profile.token if profile else None
+        wappi_profile_id = profile.profile_id if profile else None
         
-        endpoint_map = {
-            'max': 'https://wappi.pro/maxapi/sync/message/send',
-            'telegram_bot': 'https://wappi.pro/tapi/sync/message/send',
-            'whatsapp_business': 'https://wappi.pro/api/sync/message/send',
-            'wappi': 'https://wappi.pro/api/sync/message/send'
-        }
+        if not wappi_token or not wappi_profile_id:
+            return 500, json.dumps({"error": "Wappi credentials not configured"}), None
         
-        api_url = endpoint_map.get(provider_type, 'https://wappi.pro/api/sync/message/send')
+        send_mode = 'async' if provider.config.get('wappi_async') else 'sync'
+        api_url = f"{WAPPI_ENDPOINTS.get(provider.provider_type, WAPPI_ENDPOINTS['wappi'])}/{send_mode}/message/send"
         
         recipient_clean = recipient.replace('+', '').replace('-', '').replace(' ', '')
         
@@ -143,236 +1014,1340 @@ def send_via_wappi(recipient: str, message: str, provider: str, conn) -> Tuple[i
         })
         
         print(f"[WAPPI] Sending request:")
-        print(f"[WAPPI] Provider code: {provider}")
-        print(f"[WAPPI] Provider type: {provider_type}")
+        print(f"[WAPPI] Provider code: {provider.provider_code}")
+        print(f"[WAPPI] Provider type: {provider.provider_type}")
         print(f"[WAPPI] URL: {api_url}?profile_id={wappi_profile_id}")
         print(f"[WAPPI] Headers: Authorization: {wappi_token[:10]}...")
         print(f"[WAPPI] Data: {request_data}")
         
-        response = requests.post(
+        response = get_http_session(WAPPI_HOST).post(
             api_url,
             params={'profile_id': wappi_profile_id},
             headers={
                 'Authorization': wappi_token
             },
             data=request_data,
-            timeout=10
+            stream=True
         )
+        response_body = read_response_body(response)
         
         print(f"[WAPPI] Response status: {response.status_code}")
-        print(f"[WAPPI] Response body: {response.text}")
+        print(f"[WAPPI] Response body: {response_body[:RESPONSE_BODY_PREVIEW_CHARS]}")
+        
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
         
         if response.status_code == 200:
             try:
-                response_data = response.json()
+                response_data = json.loads(response_body)
                 if response_data.get('status') == 'done':
-                    return 200, response.text
+                    return (SENT_STATUS_CODE if send_mode == 'async' else 200), response_body, None
                 else:
-                    return 500, response.text
+                    return 500, response_body, retry_after
             except:
-                return response.status_code, response.text
+                return response.status_code, response_body, retry_after
         
-        return response.status_code, response.text
+        return response.status_code, response_body, retry_after
         
     except requests.exceptions.Timeout:
-        return 500, json.dumps({"error": "Request timeout"})
+        return 500, json.dumps({"error": "Request timeout"}), None
     except requests.exceptions.RequestException as e:
-        return 500, json.dumps({"error": str(e)})
+        return 500, json.dumps({"error": str(e)}), None
+
+class SigV4Signer:
+    """Подпись AWS SigV4 для POST на один endpoint (Yandex Postbox)
+    
+    host, region, service и канонический URI фиксированы для экземпляра, поэтому
+    постоянные части канонического запроса собираются один раз. Производный ключ
+    k_signing (четыре HMAC) кэшируется по (secret_key, дата) и живет весь день,
+    так что на письмо остается один HMAC по string-to-sign.
+    """
+    
+    ALGORITHM = 'AWS4-HMAC-SHA256'
+    SIGNED_HEADERS = 'content-type;host;x-amz-date'
+    MAX_CACHED_KEYS = 64
+    
+    def __init__(self, host: str, region: str, service: str, canonical_uri: str, content_type: str):
+        self.host = host
+        self.region = region
+        self.service = service
+        self.content_type = content_type
+        self._request_prefix = f'POST\n{canonical_uri}\n\ncontent-type:{content_type}\nhost:{host}\nx-amz-date:'
+        self._request_suffix = f'\n\n{self.SIGNED_HEADERS}\n'
+        self._scope_suffix = f'/{region}/{service}/aws4_request'
+        self._signing_keys: Dict[Tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+    
+    def _signing_key(self, secret_key: str, date_stamp: str) -> bytes:
+        cache_key = (secret_key, date_stamp)
+        signing_key = self._signing_keys.get(cache_key)
+        if signing_key is not None:
+            return signing_key
+        
+        k_date = hmac.new(('AWS4' + secret_key).encode('utf-8'), date_stamp.encode('utf-8'), hashlib.sha256).digest()
+        k_region = hmac.new(k_date, self.region.encode('utf-8'), hashlib.sha256).digest()
+        k_service = hmac.new(k_region, self.service.encode('utf-8'), hashlib.sha256).digest()
+        signing_key = hmac.new(k_service, b'aws4_request', hashlib.sha256).digest()
+        
+        with self._lock:
+            if len(self._signing_keys) >= self.MAX_CACHED_KEYS:
+                self._signing_keys.clear()
+            self._signing_keys[cache_key] = signing_key
+        return signing_key
+    
+    def sign(self, access_key: str, secret_key: str, body: bytes,
+             now: Optional[datetime] = None) -> Dict[str, str]:
+        """Возвращает заголовки Content-Type, X-Amz-Date и Authorization для тела запроса"""
+        amz_date = (now or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = amz_date[:8]
+        
+        canonical_request = (
+            self._request_prefix + amz_date + self._request_suffix +
+            hashlib.sha256(body).hexdigest()
+        )
+        credential_scope = date_stamp + self._scope_suffix
+        string_to_sign = (
+            f'{self.ALGORITHM}\n{amz_date}\n{credential_scope}\n' +
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        )
+        signature = hmac.new(
+            self._signing_key(secret_key, date_stamp),
+            string_to_sign.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        
+        return {
+            'Content-Type': self.content_type,
+            'X-Amz-Date': amz_date,
+            'Authorization': (
+                f'{self.ALGORITHM} Credential={access_key}/{credential_scope}, '
+                f'SignedHeaders={self.SIGNED_HEADERS}, Signature={signature}'
+            )
+        }
+
+POSTBOX_ENDPOINT = f'https://{POSTBOX_HOST}/v2/email/outbound-emails'
+_postbox_signer = SigV4Signer(POSTBOX_HOST, 'ru-central1', 'ses', '/v2/email/outbound-emails', 'application/json')
+
+def send_via_postbox(recipient: str, message: str, subject: str, provider: ProviderRecord,
+                    template_name: Optional[str] = None, template_data: Optional[Dict] = None) -> Tuple[int, str, Optional[float]]:
+    """Отправляет email через Yandex Postbox API (AWS SES compatible)
+    Поддерживает два режима:
+    - Обычная отправка (SendEmail с Simple) - если template_name не указан
+    - Отправка по шаблону (SendEmail с Template) - если указан template_name
+    """
+    try:
+        access_key = provider.config.get('postbox_access_key')
+        secret_key = provider.config.get('postbox_secret_key')
+        from_email = provider.config.get('postbox_from_email')
+        
+        if not access_key or not secret_key or not from_email:
+            return 500, json.dumps({"error": "Postbox credentials not configured"}), None
+        
+        print(f"[POSTBOX] Using Basic Auth with AWS SigV4")
+        print(f"[POSTBOX] From: {from_email}")
+        print(f"[POSTBOX] To: {recipient}")
+        print(f"[POSTBOX] Subject: {subject}")
+        
+        # Подготовка body запроса
+        if template_name:
+            body = json.dumps({
+                "FromEmailAddress": from_email,
+                "Destination": {
+                    "ToAddresses": [recipient]
+                },
+                "Content": {
+                    "Template": {
+                        "TemplateName": template_name,
+                        "TemplateData": json.dumps(template_data or {})
+                    }
+                }
+            })
+        else:
+            body = json.dumps({
+                "FromEmailAddress": from_email,
+                "Destination": {
+                    "ToAddresses": [recipient]
+                },
+                "Content": {
+                    "Simple": {
+                        "Subject": {
+                            "Data": subject,
+                            "Charset": "UTF-8"
+                        },
+                        "Body": {
+                            "Text": {
+                                "Data": message,
+                                "Charset": "UTF-8"
+                            }
+                        }
+                    }
+                }
+            })
+        
+        body_bytes = body.encode('utf-8')
+        headers = _postbox_signer.sign(access_key, secret_key, body_bytes)
+        
+        print(f"[POSTBOX] Request body: {body}")
+        
+        response = get_http_session(POSTBOX_HOST).post(
+            POSTBOX_ENDPOINT,
+            headers=headers,
+            data=body_bytes,
+            stream=True
+        )
+        response_body = read_response_body(response)
+        
+        print(f"[POSTBOX] Response status: {response.status_code}")
+        print(f"[POSTBOX] Response body: {response_body[:RESPONSE_BODY_PREVIEW_CHARS]}")
+        
+        if response.status_code == 200:
+            return 200, response_body, None
+        else:
+            return response.status_code, response_body, parse_retry_after(response.headers.get('Retry-After'))
+        
+    except Exception as e:
+        print(f"[POSTBOX ERROR] Unexpected exception:")
+        print(f"[POSTBOX ERROR] Type: {type(e).__name__}")
+        print(f"[POSTBOX ERROR] Message: {str(e)}")
+        import traceback
+        print(f"[POSTBOX ERROR] Traceback: {traceback.format_exc()}")
+        return 500, json.dumps({"error": str(e), "type": type(e).__name__}), None
+
+def simulate_provider_send(provider: str, recipient: str, message: str) -> Tuple[int, str, Optional[float]]:
+    """Симулирует отправку через провайдера (заглушка для не интегрированных провайдеров)"""
+    time.sleep(0.1)
+    
+    import random
+    success_rate = 0.8
+    
+    if random.random() < success_rate:
+        return 200, json.dumps({"success": True, "message_id": str(uuid.uuid4())}), None
+    else:
+        return 500, json.dumps({"success": False, "error": "Provider temporary unavailable"}), None
+
+def _transport_wappi(provider: ProviderRecord, recipient: str, message_text: str,
+                     options: Mapping[str, Any], profile: Optional[WappiProfile]) -> Tuple[int, str, Optional[float]]:
+    return send_via_wappi(recipient, message_text, provider, profile)
+
+def _transport_postbox(provider: ProviderRecord, recipient: str, message_text: str,
+                       options: Mapping[str, Any], profile: Optional[WappiProfile]) -> Tuple[int, str, Optional[float]]:
+    return send_via_postbox(
+        recipient, message_text, options.get('subject') or "Уведомление", provider,
+        template_name=options.get('template_name'), template_data=options.get('template_data')
+    )
+
+def _transport_simulator(provider: ProviderRecord, recipient: str, message_text: str,
+                         options: Mapping[str, Any], profile: Optional[WappiProfile]) -> Tuple[int, str, Optional[float]]:
+    return simulate_provider_send(provider.provider_code, recipient, message_text)
+
+PROVIDER_TRANSPORTS = {
+    **{provider_type: _transport_wappi for provider_type in WAPPI_ENDPOINTS},
+    'yandex_postbox': _transport_postbox
+}
+
+def dispatch_send(provider: ProviderRecord, recipient: str, message_text: str,
+                  options: Mapping[str, Any], profile: Optional[WappiProfile] = None) -> Tuple[int, str, Optional[float]]:
+    """Отправляет через транспорт типа провайдера, неизвестные типы уходят в симулятор"""
+    transport = PROVIDER_TRANSPORTS.get(provider.provider_type, _transport_simulator)
+    return transport(provider, recipient, message_text, options, profile)
+
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429})
+PERMANENT_ERROR_MARKERS = (
+    'credentials not configured',
+    'invalid recipient',
+    'recipient is not valid',
+    'not registered',
+    'messagerejected',
+    'invalidparametervalue'
+)
+
+def is_retryable(status_code: int, response_body: str) -> bool:
+    """Имеет ли смысл повторять неудачную попытку
+    
+    Повторяются 5xx, 408, 425 и 429. Остальные 4xx и известные ошибки получателя
+    или конфигурации в теле ответа постоянные: повтор их не исправит.
+    """
+    body = (response_body or '').lower()
+    if any(marker in body for marker in PERMANENT_ERROR_MARKERS):
+        return False
+    return status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+
+RESPONSE_BODY_PREVIEW_CHARS = int(os.environ.get('RESPONSE_BODY_PREVIEW_CHARS', '500'))
+RESPONSE_BODY_POLICY = os.environ.get('RESPONSE_BODY_POLICY', 'errors')
+
+def _response_json(response_body: Optional[str]) -> Dict[str, Any]:
+    try:
+        data = json.loads(response_body or '')
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def extract_provider_message_id(response_body: Optional[str]) -> Optional[str]:
+    """Идентификатор сообщения у провайдера из JSON-ответа (Wappi message_id/task_id, Postbox MessageId)"""
+    data = _response_json(response_body)
+    for field in ('message_id', 'task_id', 'MessageId'):
+        if data.get(field):
+            return str(data[field])[:255]
+    return None
+
+def extract_error_code(response_body: Optional[str]) -> Optional[str]:
+    """Код ошибки из JSON-ответа провайдера (code, error_code, Postbox Code/__type)"""
+    data = _response_json(response_body)
+    for field in ('error_code', 'code', 'Code', '__type'):
+        value = data.get(field)
+        if value is not None and not isinstance(value, (dict, list)):
+            return str(value).rsplit('#', 1)[-1][:100]
+    return None
+
+@dataclass(frozen=True)
+class CapturedResponse:
+    """Что из ответа провайдера сохраняется в delivery_attempts"""
+    preview: Optional[str]
+    body_gz: Optional[bytes]
+    provider_message_id: Optional[str]
+    error_code: Optional[str]
+
+def capture_response(provider: ProviderRecord, response_body: Optional[str], success: bool) -> CapturedResponse:
+    """Разбирает ответ провайдера по config.response_body_policy
+    
+    all - весь ответ каждой попытки хранится в gzip, errors (по умолчанию) -
+    только неудачных, none - ответ не хранится. В response_body остается начало
+    ответа (RESPONSE_BODY_PREVIEW_CHARS символов), сжатая копия пишется, только
+    если ответ длиннее. Идентификатор сообщения и код ошибки извлекаются всегда.
+    """
+    body = response_body or ''
+    policy = provider.config.get('response_body_policy') or RESPONSE_BODY_POLICY
+    keep = policy == 'all' or (policy == 'errors' and not success)
+    return CapturedResponse(
+        preview=None if policy == 'none' else body[:RESPONSE_BODY_PREVIEW_CHARS],
+        body_gz=gzip.compress(body.encode('utf-8')) if keep and len(body) > RESPONSE_BODY_PREVIEW_CHARS else None,
+        provider_message_id=extract_provider_message_id(body) if success else None,
+        error_code=None if success else extract_error_code(body)
+    )
+
+@dataclass(frozen=True)
+class AttemptOutcome:
+    """Итог одной попытки доставки
+    
+    sent - провайдер принял сообщение асинхронно, доставка еще не подтверждена.
+    """
+    success: bool
+    error: Optional[str] = None
+    retryable: bool = True
+    retry_after: Optional[float] = None
+    sent: bool = False
+    provider_message_id: Optional[str] = None
+    provider_profile_id: Optional[str] = None
+
+def attempt_delivery(message_id: str, provider: ProviderRecord, recipient: str, 
+                    message_text: str, attempt_number: int, uow: DeliveryUnitOfWork,
+                    options: Mapping[str, Any], profile: Optional[WappiProfile] = None) -> AttemptOutcome:
+    """Пытается доставить сообщение
+    
+    options - delivery_options сообщения (subject, template_name, template_data),
+    profile - профиль Wappi, выбранный WappiBalancer.
+    """
+    start_time = time.time()
+    
+    try:
+        status_code, response_body, retry_after = dispatch_send(provider, recipient, message_text, options, profile)
+        
+        duration_ms = int((time.time() - start_time) * 1000)
+        success = status_code in (200, SENT_STATUS_CODE)
+        retryable = not success and is_retryable(status_code, response_body)
+        circuit_breaker.record(provider.provider_code, not retryable)
+        provider_stats.record(provider.provider_code, duration_ms, success)
+        
+        captured = capture_response(provider, response_body, success)
+        
+        if success:
+            uow.log_attempt(message_id, attempt_number, provider.provider_code, 'success', 
+                            status_code, captured.preview, None, duration_ms,
+                            captured.body_gz, captured.provider_message_id)
+            return AttemptOutcome(
+                True,
+                sent=status_code == SENT_STATUS_CODE,
+                provider_message_id=captured.provider_message_id,
+                provider_profile_id=profile.profile_id if profile else None
+            )
+        else:
+            error_msg = f"Provider returned status {status_code}"
+            uow.log_attempt(message_id, attempt_number, provider.provider_code, 'failed', 
+                            status_code, captured.preview, error_msg, duration_ms,
+                            captured.body_gz, None, captured.error_code)
+            return AttemptOutcome(False, error_msg, retryable, retry_after)
+            
+    except Exception as e:
+        duration_ms = int((time.time() - start_time) * 1000)
+        circuit_breaker.record(provider.provider_code, False)
+        provider_stats.record(provider.provider_code, duration_ms, False)
+        error_msg = str(e)
+        uow.log_attempt(message_id, attempt_number, provider.provider_code, 'error', 
+                        None, '', error_msg, duration_ms)
+        return AttemptOutcome(False, error_msg)
+
+RETRY_DELAYS = [0, 1, 3]
+RETRY_SCHEDULE_BASE = float(os.environ.get('RETRY_SCHEDULE_BASE', '60'))
+RETRY_SCHEDULE_MAX = float(os.environ.get('RETRY_SCHEDULE_MAX', '3600'))
+RETRY_BASE_MIN = float(os.environ.get('RETRY_BASE_MIN', '1'))
+RETRY_STATS_WINDOW = int(os.environ.get('RETRY_STATS_WINDOW', '3600'))
+RETRY_STATS_REFRESH = float(os.environ.get('RETRY_STATS_REFRESH', '60'))
+RETRY_STATS_MIN_SAMPLES = int(os.environ.get('RETRY_STATS_MIN_SAMPLES', '20'))
+RETRY_INLINE_MIN_SUCCESS = float(os.environ.get('RETRY_INLINE_MIN_SUCCESS', '0.5'))
+PROVIDER_STATS_WINDOW = int(os.environ.get('PROVIDER_STATS_WINDOW', '900'))
+PROVIDER_STATS_MAX_SAMPLES = int(os.environ.get('PROVIDER_STATS_MAX_SAMPLES', '500'))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', '5'))
+RATE_LIMITED_ERROR = 'Provider rate limit reached'
+DELIVERY_MAX_IN_FLIGHT = int(os.environ.get('DELIVERY_MAX_IN_FLIGHT', '200'))
+DELIVERY_PROVIDER_MAX_IN_FLIGHT = int(os.environ.get('DELIVERY_PROVIDER_MAX_IN_FLIGHT', '50'))
+
+@dataclass
+class DeliveryJob:
+    """Сообщение в работе у движка доставки и результат его попыток"""
+    message_id: str
+    provider: ProviderRecord
+    recipient: str
+    message_text: str
+    options: Dict[str, Any]
+    attempts: int = 0
+    max_attempts: int = MESSAGE_MAX_ATTEMPTS
+    success: bool = False
+    last_error: Optional[str] = None
+    retry_in: Optional[float] = None
+    deferred: bool = False
+    defer_reason: Optional[str] = None
+    defer_for: float = 0.0
+    wait: float = 0.0
+    permanent: bool = False
+    retry_after: Optional[float] = None
+    route: Tuple[ProviderRecord, ...] = ()
+    channel: int = 0
+    route_retryable: bool = False
+    wappi_profile: Optional[WappiProfile] = None
+    sent: bool = False
+    provider_message_id: Optional[str] = None
+    provider_profile_id: Optional[str] = None
+    
+    def failover(self) -> bool:
+        """Переключает задание на следующий канал маршрута, False - каналы закончились"""
+        if self.channel + 1 >= len(self.route):
+            return False
+        self.route_retryable = self.route_retryable or not self.permanent
+        self.channel += 1
+        self.provider = self.route[self.channel]
+        self.permanent = False
+        self.retry_after = None
+        return True
+    
+    def defer(self, reason: str, seconds: float) -> None:
+        """Откладывает задание без попытки: провайдер сейчас не примет сообщение"""
+        self.deferred = True
+        self.defer_reason = reason
+        self.defer_for = max(self.defer_for, seconds)
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Параметры повторов провайдера: экспоненциальная задержка с full jitter"""
+    base: float = RETRY_SCHEDULE_BASE
+    cap: float = RETRY_SCHEDULE_MAX
+    inline: bool = True
+    
+    def delay(self, attempts: int, retry_after: Optional[float] = None) -> float:
+        """Случайная задержка из [0, min(cap, base * 2^(attempts-1))], не меньше Retry-After"""
+        ceiling = min(self.cap, self.base * 2 ** max(attempts - 1, 0))
+        return max(random.uniform(0, ceiling), retry_after or 0.0)
+
+class RetryPolicyBook:
+    """Политики повторов по провайдерам из статистики delivery_attempts
+    
+    Раз в refresh_interval секунд считает долю успешных повторных попыток
+    (attempt_number > 1) за последние window секунд. Если повторы обычно
+    помогают, сбои кратковременные: базовая задержка ближе к RETRY_BASE_MIN
+    и разрешены быстрые повторы в запросе. Если не помогают - задержка растет
+    до RETRY_SCHEDULE_BASE, а повторы в запросе не делаются.
+    """
+    
+    def __init__(self, window: int, refresh_interval: float, min_samples: int):
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.min_samples = min_samples
+        self._policies: Dict[str, RetryPolicy] = {}
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+    
+    def policy_from_stats(self, retries: int, succeeded: int) -> RetryPolicy:
+        if retries < self.min_samples:
+            return RetryPolicy()
+        success_rate = succeeded / retries
+        return RetryPolicy(
+            base=RETRY_BASE_MIN + (RETRY_SCHEDULE_BASE - RETRY_BASE_MIN) * (1 - success_rate),
+            inline=success_rate >= RETRY_INLINE_MIN_SUCCESS
+        )
+    
+    def get(self, provider_code: str) -> RetryPolicy:
+        with self._lock:
+            return self._policies.get(provider_code) or RetryPolicy()
+    
+    def sync(self, conn) -> None:
+        now = time.monotonic()
+        if now - self._refreshed_at < self.refresh_interval:
+            return
+        
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT provider, COUNT(*) AS retries,
+                   COUNT(*) FILTER (WHERE status = 'success') AS succeeded
+            FROM delivery_attempts
+            WHERE attempted_at > NOW() - %s * INTERVAL '1 second' AND attempt_number > 1
+            GROUP BY provider""",
+            (self.window,)
+        )
+        rows = cur.fetchall()
+        cur.close()
+        
+        policies = {row['provider']: self.policy_from_stats(row['retries'], row['succeeded']) for row in rows}
+        with self._lock:
+            self._policies = policies
+            self._refreshed_at = now
+
+retry_policies = RetryPolicyBook(RETRY_STATS_WINDOW, RETRY_STATS_REFRESH, RETRY_STATS_MIN_SAMPLES)
+
+class ProviderStats:
+    """Скользящее окно длительности и исхода попыток по провайдерам
+    
+    Хранит не больше max_samples последних попыток каждого провайдера за window
+    секунд. При первом обращении окно заполняется из delivery_attempts, дальше
+    пополняется из attempt_delivery. По окну ранжируются каналы маршрута
+    с route_selection = fastest: чем меньше p95 длительности, деленный на долю
+    успешных попыток, тем раньше канал. Каналы без статистики идут первыми,
+    чтобы ее набрать.
+    """
+    
+    def __init__(self, window: int, max_samples: int):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples: Dict[str, deque] = {}
+        self._seeded = False
+        self._lock = threading.Lock()
+    
+    def _add(self, provider_code: str, at: float, duration_ms: int, success: bool) -> None:
+        samples = self._samples.get(provider_code)
+        if samples is None:
+            samples = self._samples[provider_code] = deque(maxlen=self.max_samples)
+        samples.append((at, duration_ms, success))
+    
+    def record(self, provider_code: str, duration_ms: int, success: bool) -> None:
+        with self._lock:
+            self._add(provider_code, time.monotonic(), duration_ms, success)
+    
+    def seed(self, conn) -> None:
+        """Заполняет окно попытками из delivery_attempts (один раз за жизнь экземпляра)"""
+        if self._seeded:
+            return
+        
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT provider, duration_ms, status = 'success' AS success,
+                   EXTRACT(EPOCH FROM NOW() - attempted_at) AS age
+            FROM (
+                SELECT provider, duration_ms, status, attempted_at,
+                       ROW_NUMBER() OVER (PARTITION BY provider ORDER BY attempted_at DESC) AS n
+                FROM delivery_attempts
+                WHERE attempted_at > NOW() - %s * INTERVAL '1 second' AND duration_ms IS NOT NULL
+            ) recent
+            WHERE n <= %s
+            ORDER BY attempted_at""",
+            (self.window, self.max_samples)
+        )
+        rows = cur.fetchall()
+        cur.close()
+        
+        now = time.monotonic()
+        with self._lock:
+            if self._seeded:
+                return
+            for row in rows:
+                self._add(row['provider'], now - float(row['age']), row['duration_ms'], row['success'])
+            self._seeded = True
+    
+    def summary(self, provider_code: str) -> Optional[Tuple[float, float]]:
+        """p95 длительности (мс) и доля успешных попыток за окно, None - попыток не было"""
+        horizon = time.monotonic() - self.window
+        with self._lock:
+            samples = self._samples.get(provider_code)
+            while samples and samples[0][0] < horizon:
+                samples.popleft()
+            if not samples:
+                return None
+            durations = sorted(sample[1] for sample in samples)
+            successes = sum(1 for sample in samples if sample[2])
+        
+        p95 = durations[math.ceil(0.95 * len(durations)) - 1]
+        return float(p95), successes / len(durations)
+    
+    def score(self, provider_code: str) -> float:
+        """Ожидаемое время до успешной доставки через провайдера"""
+        summary = self.summary(provider_code)
+        if summary is None:
+            return 0.0
+        p95, success_rate = summary
+        return p95 / max(success_rate, 0.05)
+    
+    def rank(self, route: List[ProviderRecord], conn) -> List[ProviderRecord]:
+        """Каналы маршрута от самого быстрого к самому медленному"""
+        self.seed(conn)
+        return sorted(route, key=lambda record: self.score(record.provider_code))
+
+provider_stats = ProviderStats(PROVIDER_STATS_WINDOW, PROVIDER_STATS_MAX_SAMPLES)
+
+def next_retry_delay(job: DeliveryJob) -> Optional[float]:
+    """Задержка перед следующей попыткой, None - попытки исчерпаны или ошибка постоянная
+    
+    Постоянная ошибка последнего канала маршрута не отменяет повторов,
+    если на предыдущих каналах ошибки были временными.
+    """
+    if (job.permanent and not job.route_retryable) or job.attempts >= job.max_attempts:
+        return None
+    return round(retry_policies.get(job.provider.provider_code).delay(job.attempts, job.retry_after), 3)
+
+class RateLimiter:
+    """Token bucket на провайдера и на профиль Wappi, общий для всех экземпляров
+    
+    Лимиты задаются в providers.config:
+      rate_limit, rate_burst - сообщений в секунду и емкость корзины провайдера;
+      wappi_rate_limit, wappi_rate_burst - то же для профиля Wappi, выбранного
+      заданию (или rate_limit/rate_burst профиля из wappi_profiles; один профиль
+      может обслуживать несколько провайдеров).
+    Корзины хранятся в rate_limit_buckets, токены резервируются под блокировкой
+    строки (FOR UPDATE), поэтому экземпляры функции делят один лимит.
+    Если токен освободится в пределах max_wait секунд, попытка ждет его,
+    иначе задание откладывается планировщику на время, когда токен появится.
+    """
+    
+    def __init__(self, max_wait: float):
+        self.max_wait = max_wait
+    
+    @staticmethod
+    def buckets(job: DeliveryJob) -> List[Tuple[str, float, float]]:
+        """Корзины задания: (ключ, токенов в секунду, емкость)"""
+        provider = job.provider
+        buckets = []
+        rate = float(provider.config.get('rate_limit') or 0)
+        if rate > 0:
+            burst = float(provider.config.get('rate_burst') or rate)
+            buckets.append((f'provider:{provider.provider_code}', rate, burst))
+        
+        profile = job.wappi_profile
+        if profile and profile.rate_limit > 0:
+            buckets.append((f'wappi_profile:{profile.profile_id}', profile.rate_limit, profile.rate_burst))
+        return buckets
+    
+    def reserve(self, bucket_key: str, rate: float, burst: float, count: int, conn) -> List[float]:
+        """Резервирует до count токенов, возвращает ожидание до каждого выданного токена"""
+        cur = conn.cursor()
+        cur.execute(
+            """INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (bucket_key) DO NOTHING""",
+            (bucket_key, burst)
+        )
+        cur.execute(
+            """SELECT tokens, EXTRACT(EPOCH FROM NOW() - updated_at) AS elapsed
+            FROM rate_limit_buckets WHERE bucket_key = %s FOR UPDATE""",
+            (bucket_key,)
+        )
+        row = cur.fetchone()
+        tokens = min(burst, row['tokens'] + rate * max(float(row['elapsed']), 0.0))
+        
+        waits: List[float] = []
+        while len(waits) < count:
+            wait = max(1 - tokens, 0.0) / rate
+            if wait > self.max_wait:
+                break
+            waits.append(wait)
+            tokens -= 1
+        
+        cur.execute(
+            "UPDATE rate_limit_buckets SET tokens = %s, updated_at = NOW() WHERE bucket_key = %s",
+            (tokens, bucket_key)
+        )
+        conn.commit()
+        cur.close()
+        return waits
+    
+    def refund(self, bucket_key: str, burst: float, count: int, conn) -> None:
+        """Возвращает в корзину count токенов, зарезервированных под отложенные задания"""
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE rate_limit_buckets SET tokens = LEAST(tokens + %s, %s) WHERE bucket_key = %s",
+            (count, burst, bucket_key)
+        )
+        conn.commit()
+        cur.close()
+    
+    def admit(self, jobs: List[DeliveryJob], conn) -> None:
+        """Назначает заданиям ожидание токенов, не получившие токен откладывает
+        
+        Задание проходит, только получив токен во всех своих корзинах; если оно
+        отложено по одной корзине, токены, уже взятые в других, возвращаются.
+        """
+        by_bucket: Dict[Tuple[str, float, float], List[DeliveryJob]] = {}
+        for job in jobs:
+            for bucket in self.buckets(job):
+                by_bucket.setdefault(bucket, []).append(job)
+        
+        reserved: Dict[Tuple[str, float, float], List[DeliveryJob]] = {}
+        for bucket, bucket_jobs in by_bucket.items():
+            bucket_key, rate, burst = bucket
+            bucket_jobs = [job for job in bucket_jobs if not job.deferred]
+            if not bucket_jobs:
+                continue
+            
+            waits = self.reserve(bucket_key, rate, burst, len(bucket_jobs), conn)
+            reserved[bucket] = bucket_jobs[:len(waits)]
+            for index, job in enumerate(bucket_jobs):
+                if index < len(waits):
+                    job.wait = max(job.wait, waits[index])
+                else:
+                    job.defer(RATE_LIMITED_ERROR, self.max_wait + (index - len(waits) + 1) / rate)
+        
+        for (bucket_key, rate, burst), bucket_jobs in reserved.items():
+            unused = sum(1 for job in bucket_jobs if job.deferred)
+            if unused:
+                self.refund(bucket_key, burst, unused, conn)
+
+rate_limiter = RateLimiter(RATE_LIMIT_MAX_WAIT)
+
+def admit_jobs(jobs: List[DeliveryJob], conn) -> List[DeliveryJob]:
+    """Отбирает задания, которые можно отправлять сейчас
+    
+    Если цепь провайдера разомкнута, задание переходит на следующий канал
+    маршрута; откладываются задания, у которых рабочих каналов не осталось,
+    и не получившие токен лимита. Заданиям Wappi выбирается профиль (job.wappi_profile),
+    остальным назначается ожидание токена (job.wait).
+    """
+    for job in jobs:
+        job.deferred, job.defer_reason, job.defer_for, job.wait = False, None, 0.0, 0.0
+        while not circuit_breaker.allow(job.provider.provider_code):
+            if not job.failover():
+                job.defer(CIRCUIT_OPEN_ERROR, circuit_breaker.retry_after(job.provider.provider_code))
+                break
+        if not job.deferred and job.provider.provider_type in WAPPI_ENDPOINTS:
+            job.wappi_profile = wappi_balancer.acquire(job.provider)
+    
+    rate_limiter.admit([job for job in jobs if not job.deferred], conn)
+    
+    for job in jobs:
+        if job.defer_reason == RATE_LIMITED_ERROR:
+            circuit_breaker.release(job.provider.provider_code)
+            if job.wappi_profile:
+                wappi_balancer.release(job.provider, job.wappi_profile)
+                job.wappi_profile = None
+    return [job for job in jobs if not job.deferred]
+
+def load_route(provider_code: str, options: Mapping[str, Any], conn) -> List[ProviderRecord]:
+    """Активные провайдеры маршрута сообщения: route из delivery_options или один provider
+    
+    С route_selection = fastest каналы упорядочиваются по ProviderStats.
+    """
+    route = []
+    for code in options.get('route') or [provider_code]:
+        record = get_provider(code, conn)
+        if record and record.is_active:
+            route.append(record)
+    
+    if options.get('route_selection') == 'fastest':
+        route = provider_stats.rank(route, conn)
+    return route
+
+def job_from_message(message: Dict, conn) -> Optional[DeliveryJob]:
+    """Готовит задание доставки сохраненного сообщения, None - нет активных провайдеров"""
+    options = message['delivery_options'] or {}
+    route = load_route(message['provider'], options, conn)
+    
+    if not route:
+        return None
+    
+    return DeliveryJob(
+        message_id=message['message_id'],
+        provider=route[0],
+        recipient=message['recipient'],
+        message_text=message['message_text'],
+        options=options,
+        attempts=message['attempts'],
+        max_attempts=message['max_attempts'] or MESSAGE_MAX_ATTEMPTS,
+        route=tuple(route)
+    )
+
+def sync_delivery_state(conn) -> None:
+    """Подтягивает общее состояние доставки: цепи провайдеров и политики повторов"""
+    circuit_breaker.sync(conn)
+    retry_policies.sync(conn)
+
+class DeliveryEngine:
+    """asyncio-движок параллельной доставки
+    
+    Транспорты Wappi, Postbox и симулятор блокирующие, поэтому каждая попытка
+    выполняется в пуле потоков, а asyncio держит до max_in_flight попыток
+    одновременно и не больше лимита провайдера на каждого провайдера
+    (config.max_in_flight или provider_max_in_flight на каждый профиль Wappi). Перед запуском
+    admit_jobs откладывает (deferred) задания провайдеров с разомкнутой цепью
+    или исчерпанным лимитом; ожидание токена выполняется до занятия слота.
+    Попытки пишутся в DeliveryUnitOfWork, к БД во время попыток движок не обращается.
+    """
+    
+    def __init__(self, max_in_flight: int, provider_max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.provider_max_in_flight = provider_max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='delivery')
+    
+    def provider_limit(self, provider: ProviderRecord) -> int:
+        if provider.config.get('max_in_flight'):
+            return int(provider.config['max_in_flight'])
+        if provider.provider_type in WAPPI_ENDPOINTS:
+            return self.provider_max_in_flight * max(len(wappi_profiles(provider)), 1)
+        return self.provider_max_in_flight
+    
+    async def _attempt(self, job: DeliveryJob, uow: DeliveryUnitOfWork,
+                       in_flight: asyncio.Semaphore, provider_slots: asyncio.Semaphore) -> AttemptOutcome:
+        healthy = None
+        try:
+            if job.wait:
+                await asyncio.sleep(job.wait)
+            async with in_flight, provider_slots:
+                outcome = await asyncio.get_running_loop().run_in_executor(
+                    self._executor,
+                    partial(
+                        attempt_delivery,
+                        job.message_id, job.provider, job.recipient, job.message_text, job.attempts + 1, uow,
+                        job.options, job.wappi_profile
+                    )
+                )
+            healthy = outcome.success or not outcome.retryable
+            return outcome
+        finally:
+            if job.wappi_profile:
+                wappi_balancer.release(job.provider, job.wappi_profile, healthy)
+                job.wappi_profile = None
+    
+    async def attempt_all_async(self, jobs: List[DeliveryJob], uow: DeliveryUnitOfWork) -> None:
+        """Делает по одной попытке для каждого допущенного задания, не превышая лимиты"""
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        provider_slots: Dict[str, asyncio.Semaphore] = {}
+        for job in jobs:
+            if job.provider.provider_code not in provider_slots:
+                provider_slots[job.provider.provider_code] = asyncio.Semaphore(self.provider_limit(job.provider))
+        
+        outcomes = await asyncio.gather(*(
+            self._attempt(job, uow, in_flight, provider_slots[job.provider.provider_code])
+            for job in jobs
+        ))
+        
+        for job, outcome in zip(jobs, outcomes):
+            job.attempts += 1
+            job.success = outcome.success
+            job.last_error = outcome.error
+            job.permanent = not outcome.retryable
+            job.retry_after = outcome.retry_after
+            job.sent = outcome.sent
+            job.provider_message_id = outcome.provider_message_id
+            job.provider_profile_id = outcome.provider_profile_id
+    
+    def attempt_all(self, jobs: List[DeliveryJob], uow: DeliveryUnitOfWork) -> None:
+        """Отбирает допущенные задания и синхронно выполняет для них attempt_all_async"""
+        admitted = admit_jobs(jobs, uow.conn)
+        if admitted:
+            asyncio.run(self.attempt_all_async(admitted, uow))
+
+delivery_engine = DeliveryEngine(DELIVERY_MAX_IN_FLIGHT, DELIVERY_PROVIDER_MAX_IN_FLIGHT)
+
+def attempt_with_failover(jobs: List[DeliveryJob], uow: DeliveryUnitOfWork) -> None:
+    """Делает попытку каждого задания, после неудачи сразу пробует следующие каналы маршрута
+    
+    Сохраненные сообщения (планировщик, повторы) всегда начинают с первого канала,
+    поэтому без переключения неработающий канал повторялся бы до размыкания цепи,
+    а постоянная ошибка на нем завершала бы доставку, не дойдя до остальных каналов.
+    """
+    pending = jobs
+    while pending:
+        delivery_engine.attempt_all(pending, uow)
+        pending = [job for job in pending if not job.success and not job.deferred and job.failover()]
+
+def job_status(job: DeliveryJob) -> str:
+    """Статус сообщения по итогам заданий: отложенное без попыток остается в очереди,
+    принятое асинхронным endpoint провайдера - sent до сверки статуса доставки"""
+    if job.success:
+        return 'sent' if job.sent else 'delivered'
+    return 'queued' if job.attempts == 0 else 'failed'
+
+def finish_jobs(jobs: List[DeliveryJob], uow: DeliveryUnitOfWork) -> None:
+    """Записывает итоговые статусы заданий; неудачным назначается следующая попытка
+    
+    Отложенные без попытки повторяются, когда провайдер сможет их принять:
+    цепь перейдет в half_open или в корзине лимита появится токен.
+    Статус отправленных (sent) планировщик проверит через SENT_RECONCILE_DELAY секунд.
+    После переключения маршрута в сообщение записывается провайдер, через которого
+    прошла последняя попытка: по нему сверяется статус и строится журнал.
+    """
+    for job in jobs:
+        if job.success:
+            uow.update_message_status(
+                job.message_id, job_status(job), job.attempts, None,
+                SENT_RECONCILE_DELAY if job.sent else None,
+                job.provider_message_id, job.provider_profile_id,
+                job.provider.provider_code
+            )
+            continue
+        
+        job.retry_in = next_retry_delay(job)
+        if job.deferred and job.retry_in is not None:
+            job.retry_in = round(max(job.retry_in, job.defer_for) if job.attempts else job.defer_for, 3)
+        uow.update_message_status(job.message_id, job_status(job), job.attempts,
+                                  job.last_error or job.defer_reason, job.retry_in,
+                                  provider=job.provider.provider_code)
+
+# <<< общее ядро доставки
+
+INLINE_ATTEMPTS = 3
+SCHEDULER_BATCH_SIZE = int(os.environ.get('SCHEDULER_BATCH_SIZE', '100'))
+SCHEDULER_MAX_BATCH_SIZE = int(os.environ.get('SCHEDULER_MAX_BATCH_SIZE', '1000'))
+SCHEDULER_TIME_BUDGET = float(os.environ.get('SCHEDULER_TIME_BUDGET', '25'))
+
+def retries_inline(job: DeliveryJob, delay: float) -> bool:
+    """Повторять ли попытку тем же каналом в запросе через delay секунд, а не отдать планировщику"""
+    return (
+        not job.success and not job.deferred and not job.permanent
+        and retry_policies.get(job.provider.provider_code).inline
+        and (job.retry_after or 0.0) <= delay
+    )
+
+def inline_rounds(jobs: List[DeliveryJob]) -> int:
+    """Раундов в запросе: INLINE_ATTEMPTS, но не меньше длины самого длинного маршрута"""
+    return max([INLINE_ATTEMPTS] + [len(job.route) for job in jobs])
+
+def deliver_inline(jobs: List[DeliveryJob], conn) -> None:
+    """Доставляет сообщения в запросе раундами параллельных попыток
+    
+    После неудачи задание с маршрутом сразу переходит на следующий канал.
+    Тем же каналом попытка повторяется после паузы со случайной задержкой
+    из [0, RETRY_DELAYS[n]]; постоянные ошибки, Retry-After дольше паузы
+    и провайдеры, у которых повторы обычно не помогают, в запросе не повторяются.
+    Если попытки в запросе не помогли или цепь провайдера разомкнута,
+    следующая попытка назначается планировщику. Попытки и статусы всех
+    сообщений пишутся одним commit.
+    """
+    sync_delivery_state(conn)
+    uow = DeliveryUnitOfWork(conn)
+    pending = jobs
+    rounds = inline_rounds(jobs)
+    for attempt in range(1, rounds + 1):
+        delivery_engine.attempt_all(pending, uow)
+        if attempt == rounds:
+            break
+        
+        delay = RETRY_DELAYS[min(attempt, len(RETRY_DELAYS) - 1)]
+        switched: List[DeliveryJob] = []
+        same_channel: List[DeliveryJob] = []
+        for job in pending:
+            if job.success or job.deferred:
+                continue
+            if job.failover():
+                switched.append(job)
+            elif retries_inline(job, delay):
+                same_channel.append(job)
+        
+        pending = switched + same_channel
+        if not pending:
+            break
+        if same_channel:
+            time.sleep(max([random.uniform(0, delay)] + [job.retry_after or 0.0 for job in same_channel]))
+    
+    finish_jobs(jobs, uow)
+    uow.commit()
+
+def claim_due_messages(limit: int, conn) -> List[Dict]:
+    """Забирает пачку сообщений, у которых наступил next_attempt_at
+    
+    FOR UPDATE SKIP LOCKED позволяет нескольким планировщикам работать параллельно
+    без повторной отправки: каждый получает свои строки. На время доставки
+    next_attempt_at сдвигается на DELIVERY_LEASE_SECONDS (аренда).
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """UPDATE messages
+        SET status = 'processing', next_attempt_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id IN (
+            SELECT id FROM messages
+            WHERE next_attempt_at <= NOW()
+              AND status IN ('queued', 'pending', 'processing', 'failed')
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING message_id, provider, recipient, message_text, delivery_options,
+                  attempts, max_attempts""",
+        (DELIVERY_LEASE_SECONDS, limit)
+    )
+    messages = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return messages
+
+def process_due_messages(messages: List[Dict], conn) -> Dict[str, int]:
+    """Делает попытку для каждого сообщения, забранного планировщиком (по каналам маршрута)"""
+    sync_delivery_state(conn)
+    uow = DeliveryUnitOfWork(conn)
+    jobs: List[DeliveryJob] = []
+    stats = {'delivered': 0, 'sent': 0, 'failed': 0, 'deferred': 0}
+    
+    for message in messages:
+        job = job_from_message(message, conn)
+        
+        if job is None:
+            uow.update_message_status(message['message_id'], 'failed', message['attempts'],
+                                      'Provider unknown or inactive')
+            stats['failed'] += 1
+            continue
+        
+        jobs.append(job)
+    
+    attempt_with_failover(jobs, uow)
+    finish_jobs(jobs, uow)
+    uow.commit()
+    
+    for job in jobs:
+        stats['deferred' if job.deferred else job_status(job) if job.success else 'failed'] += 1
+    return stats
+
+SENT_RECONCILE_INTERVAL = float(os.environ.get('SENT_RECONCILE_INTERVAL', '60'))
+SENT_RECONCILE_MAX_AGE = int(os.environ.get('SENT_RECONCILE_MAX_AGE', '86400'))
+SENT_RECONCILE_CONCURRENCY = int(os.environ.get('SENT_RECONCILE_CONCURRENCY', '10'))
+SENT_RECONCILE_BUDGET_SHARE = float(os.environ.get('SENT_RECONCILE_BUDGET_SHARE', '0.2'))
+WAPPI_DELIVERED_STATUSES = frozenset({'delivered', 'read', 'viewed', 'played'})
+WAPPI_FAILED_STATUSES = frozenset({'error', 'failed', 'undelivered', 'rejected'})
 
-def get_postbox_credentials(provider: str, conn) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-    """Получает Yandex Postbox credentials из конфига"""
+def claim_sent_messages(limit: int, conn) -> List[Dict]:
+    """Забирает пачку сообщений в статусе sent, которым пора сверить статус доставки
+    
+    Следующая проверка сразу сдвигается на SENT_RECONCILE_INTERVAL. Сообщения,
+    отправленные раньше SENT_RECONCILE_MAX_AGE, больше не проверяются и остаются sent.
+    """
     cur = conn.cursor()
     cur.execute(
-        "SELECT config FROM providers WHERE provider_code = %s",
-        (provider,)
+        """UPDATE messages SET next_attempt_at = NULL
+        WHERE status = 'sent' AND next_attempt_at <= NOW()
+          AND last_attempt_at < NOW() - %s * INTERVAL '1 second'""",
+        (SENT_RECONCILE_MAX_AGE,)
+    )
+    cur.execute(
+        """UPDATE messages
+        SET next_attempt_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id IN (
+            SELECT id FROM messages
+            WHERE status = 'sent' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING message_id, provider, delivery_options, provider_message_id, provider_profile_id""",
+        (SENT_RECONCILE_INTERVAL, limit)
     )
-    result = cur.fetchone()
+    messages = cur.fetchall()
+    conn.commit()
     cur.close()
+    return messages
+
+def sent_message_profile(message: Dict, conn) -> Optional[Tuple[ProviderRecord, WappiProfile]]:
+    """Провайдер и профиль Wappi, которыми было отправлено сообщение
     
-    if not result or not result['config']:
-        return None, None, None
+    Провайдер берется из messages.provider (туда пишется канал, через который
+    прошла попытка), а не из маршрута: маршрут мог измениться, провайдер - быть
+    отключен, а один профиль может обслуживать несколько провайдеров.
+    """
+    provider = get_provider(message['provider'], conn)
+    if provider is None or provider.provider_type not in WAPPI_ENDPOINTS:
+        return None
+    for profile in wappi_profiles(provider):
+        if profile.profile_id == message['provider_profile_id'] or not message['provider_profile_id']:
+            return provider, profile
+    return None
+
+def fetch_wappi_delivery_status(provider: ProviderRecord, profile: WappiProfile,
+                                provider_message_id: str) -> Optional[str]:
+    """Статус доставки сообщения по данным Wappi, None - узнать не удалось"""
+    api_url = f"{WAPPI_ENDPOINTS.get(provider.provider_type, WAPPI_ENDPOINTS['wappi'])}/sync/message/get"
+    try:
+        response = get_http_session(WAPPI_HOST).get(
+            api_url,
+            params={'profile_id': profile.profile_id, 'message_id': provider_message_id},
+            headers={'Authorization': profile.token}
+        )
+        if response.status_code != 200:
+            print(f"[RECONCILE] Wappi returned {response.status_code} for {provider_message_id}")
+            return None
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[RECONCILE] Status request for {provider_message_id} failed: {e}")
+        return None
     
-    config = result['config']
-    return config.get('postbox_access_key'), config.get('postbox_secret_key'), config.get('postbox_from_email')
+    message = data.get('message') if isinstance(data.get('message'), dict) else data
+    status = message.get('delivery_status') or message.get('status')
+    return str(status).lower() if status else None
 
-def send_via_postbox(recipient: str, message: str, subject: str, provider: str, conn,
-                    template_name: Optional[str] = None, template_data: Optional[Dict] = None) -> Tuple[int, str]:
-    """Отправляет email через Yandex Postbox API (AWS SES compatible)
-    Поддерживает два режима:
-    - Обычная отправка (SendEmail с Simple) - если template_name не указан
-    - Отправка по шаблону (SendEmail с Template) - если указан template_name
+def reconcile_sent_messages(limit: int, conn) -> Dict[str, int]:
+    """Сверяет с провайдером статус доставки пачки сообщений в статусе sent
+    
+    Статусы запрашиваются параллельно; подтвержденные сообщения становятся
+    delivered, отклоненные - failed без автоматических повторов (сообщение
+    могло дойти, повтор отправит дубль). Остальные ждут следующей проверки.
     """
-    try:
-        import hashlib
-        import hmac
-        
-        access_key, secret_key, from_email = get_postbox_credentials(provider, conn)
-        
-        if not access_key or not secret_key or not from_email:
-            return 500, json.dumps({"error": "Postbox credentials not configured"})
-        
-        print(f"[POSTBOX] Using Basic Auth with AWS SigV4")
-        print(f"[POSTBOX] From: {from_email}")
-        print(f"[POSTBOX] To: {recipient}")
-        print(f"[POSTBOX] Subject: {subject}")
-        
-        # Подготовка body запроса
-        if template_name:
-            body = json.dumps({
-                "FromEmailAddress": from_email,
-                "Destination": {
-                    "ToAddresses": [recipient]
-                },
-                "Content": {
-                    "Template": {
-                        "TemplateName": template_name,
-                        "TemplateData": json.dumps(template_data or {})
-                    }
-                }
-            })
+    messages = claim_sent_messages(limit, conn)
+    stats = {'checked': len(messages), 'delivered': 0, 'failed': 0, 'pending': 0}
+    if not messages:
+        return stats
+    
+    lookups = []
+    for message in messages:
+        target = sent_message_profile(message, conn) if message['provider_message_id'] else None
+        if target is None:
+            stats['pending'] += 1
+            continue
+        lookups.append((message['message_id'], target[0], target[1], message['provider_message_id']))
+    
+    with ThreadPoolExecutor(max_workers=SENT_RECONCILE_CONCURRENCY) as executor:
+        statuses = list(executor.map(lambda lookup: fetch_wappi_delivery_status(*lookup[1:]), lookups))
+    
+    delivered: List[str] = []
+    failed: Dict[str, List[str]] = {}
+    for (message_id, _, _, _), status in zip(lookups, statuses):
+        if status in WAPPI_DELIVERED_STATUSES:
+            delivered.append(message_id)
+        elif status in WAPPI_FAILED_STATUSES:
+            failed.setdefault(status, []).append(message_id)
         else:
-            body = json.dumps({
-                "FromEmailAddress": from_email,
-                "Destination": {
-                    "ToAddresses": [recipient]
-                },
-                "Content": {
-                    "Simple": {
-                        "Subject": {
-                            "Data": subject,
-                            "Charset": "UTF-8"
-                        },
-                        "Body": {
-                            "Text": {
-                                "Data": message,
-                                "Charset": "UTF-8"
-                            }
-                        }
-                    }
-                }
-            })
-        
-        # AWS Signature V4
-        method = 'POST'
-        service = 'ses'
-        host = 'postbox.cloud.yandex.net'
-        region = 'ru-central1'
-        endpoint = f'https://{host}/v2/email/outbound-emails'
-        content_type = 'application/json'
-        
-        t = datetime.utcnow()
-        amz_date = t.strftime('%Y%m%dT%H%M%SZ')
-        date_stamp = t.strftime('%Y%m%d')
-        
-        canonical_uri = '/v2/email/outbound-emails'
-        canonical_querystring = ''
-        canonical_headers = f'content-type:{content_type}\nhost:{host}\nx-amz-date:{amz_date}\n'
-        signed_headers = 'content-type;host;x-amz-date'
-        payload_hash = hashlib.sha256(body.encode('utf-8')).hexdigest()
-        canonical_request = f'{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n{signed_headers}\n{payload_hash}'
-        
-        algorithm = 'AWS4-HMAC-SHA256'
-        credential_scope = f'{date_stamp}/{region}/{service}/aws4_request'
-        string_to_sign = f'{algorithm}\n{amz_date}\n{credential_scope}\n' + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
-        
-        def sign(key, msg):
-            return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-        
-        k_date = sign(('AWS4' + secret_key).encode('utf-8'), date_stamp)
-        k_region = sign(k_date, region)
-        k_service = sign(k_region, service)
-        k_signing = sign(k_service, 'aws4_request')
-        
-        signature = hmac.new(k_signing, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
-        authorization_header = f'{algorithm} Credential={access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}'
-        
-        headers = {
-            'Content-Type': content_type,
-            'X-Amz-Date': amz_date,
-            'Authorization': authorization_header
-        }
-        
-        print(f"[POSTBOX] Request body: {body}")
-        
-        response = requests.post(
-            endpoint,
-            headers=headers,
-            data=body,
-            timeout=30
+            stats['pending'] += 1
+    
+    cur = conn.cursor()
+    if delivered:
+        cur.execute(
+            """UPDATE messages
+            SET status = 'delivered', completed_at = NOW(), next_attempt_at = NULL
+            WHERE status = 'sent' AND message_id = ANY(%s)""",
+            (delivered,)
         )
+        stats['delivered'] += len(delivered)
+    for status, message_ids in failed.items():
+        cur.execute(
+            """UPDATE messages
+            SET status = 'failed', last_error = %s, next_attempt_at = NULL
+            WHERE status = 'sent' AND message_id = ANY(%s)""",
+            (f'Provider reported delivery status {status}', message_ids)
+        )
+        stats['failed'] += len(message_ids)
+    conn.commit()
+    cur.close()
+    return stats
+
+def run_scheduler(batch_size: int, time_budget: float, conn) -> Dict[str, Any]:
+    """Разбирает очередь: асинхронно принятые сообщения, повторы и брошенные доставки
+    
+    Забирает сообщения пачками по batch_size, пока они есть и не истекла доля
+    time_budget для очереди. Остаток бюджета, но не меньше
+    SENT_RECONCILE_BUDGET_SHARE, уходит на сверку статуса доставки отправленных
+    асинхронно (sent), чтобы постоянная очередь не оставляла их без проверки.
+    """
+    started = time.monotonic()
+    deadline = started + time_budget
+    claim_deadline = started + time_budget * (1 - SENT_RECONCILE_BUDGET_SHARE)
+    stats: Dict[str, Any] = {'claimed': 0, 'delivered': 0, 'sent': 0, 'failed': 0, 'deferred': 0}
+    
+    while time.monotonic() < claim_deadline:
+        messages = claim_due_messages(batch_size, conn)
+        if not messages:
+            break
         
-        print(f"[POSTBOX] Response status: {response.status_code}")
-        print(f"[POSTBOX] Response body: {response.text}")
-        
-        if response.status_code == 200:
-            return 200, response.text
-        else:
-            return response.status_code, response.text
-        
-    except Exception as e:
-        print(f"[POSTBOX ERROR] Unexpected exception:")
-        print(f"[POSTBOX ERROR] Type: {type(e).__name__}")
-        print(f"[POSTBOX ERROR] Message: {str(e)}")
-        import traceback
-        print(f"[POSTBOX ERROR] Traceback: {traceback.format_exc()}")
-        return 500, json.dumps({"error": str(e), "type": type(e).__name__})
+        stats['claimed'] += len(messages)
+        for status, count in process_due_messages(messages, conn).items():
+            stats[status] += count
+    
+    reconciled = {'checked': 0, 'delivered': 0, 'failed': 0, 'pending': 0}
+    while time.monotonic() < deadline:
+        batch = reconcile_sent_messages(batch_size, conn)
+        for status, count in batch.items():
+            reconciled[status] += count
+        if batch['checked'] < batch_size:
+            break
+    stats['reconciled'] = reconciled
+    
+    print(f"[SCHEDULER] Processed {stats['claimed']} messages: {stats['delivered']} delivered, "
+          f"{stats['sent']} sent, {stats['failed']} failed, {stats['deferred']} deferred; "
+          f"reconciled {reconciled['checked']} sent: {reconciled['delivered']} delivered, "
+          f"{reconciled['failed']} failed")
+    return stats
 
-def simulate_provider_send(provider: str, recipient: str, message: str) -> Tuple[int, str]:
-    """Симулирует отправку через провайдера (заглушка для не интегрированных провайдеров)"""
-    time.sleep(0.1)
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '1000'))
+
+def valid_idempotency_key(key: Any) -> bool:
+    """Ключ идемпотентности не обязателен, но если передан - непустая строка до 255 символов"""
+    return key is None or (isinstance(key, str) and 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH)
+
+def replay_result(message: Dict) -> Dict[str, Any]:
+    """Ответ на повтор запроса с уже принятым ключом идемпотентности"""
+    result = {
+        'success': message['status'] != 'failed',
+        'message_id': message['message_id'],
+        'provider': message['provider'],
+        'status': message['status'],
+        'attempts': message['attempts'],
+        'replayed': True
+    }
+    if message['status'] == 'failed':
+        result['error'] = message.get('last_error')
+    return result
+
+def replay_status_code(status: str) -> int:
+    """HTTP код повтора - тот же, что вернул бы исходный запрос при текущем статусе сообщения"""
+    if status in ('delivered', 'sent'):
+        return 200
+    if status == 'failed':
+        return 500
+    return 202
+
+ROUTE_MAX_LENGTH = int(os.environ.get('ROUTE_MAX_LENGTH', '5'))
+
+ROUTE_SELECTIONS = ('ordered', 'fastest')
+
+def valid_route(route: Any) -> bool:
+    """Маршрут - непустой список кодов провайдеров не длиннее ROUTE_MAX_LENGTH"""
+    return (
+        isinstance(route, list) and 0 < len(route) <= ROUTE_MAX_LENGTH
+        and all(isinstance(code, str) and code for code in route)
+    )
+
+def resolve_route(codes: List[str], conn) -> Tuple[List[ProviderRecord], Optional[str], Optional[str]]:
+    """Активные провайдеры маршрута или ошибка и код провайдера, к которому она относится"""
+    records = []
+    for code in codes:
+        record = get_provider(code, conn)
+        if not record:
+            return [], 'Unknown provider', code
+        records.append(record)
     
-    import random
-    success_rate = 0.8
+    active = [record for record in records if record.is_active]
+    if not active:
+        return [], 'Provider inactive', codes[0]
+    return active, None, None
+
+def validate_batch_item(item: Any, conn) -> Tuple[List[ProviderRecord], Optional[str]]:
+    """Проверяет одно сообщение пачки, возвращает активные провайдеры маршрута или текст ошибки"""
+    if not isinstance(item, dict):
+        return [], 'Message must be an object'
     
-    if random.random() < success_rate:
-        return 200, json.dumps({"success": True, "message_id": str(uuid.uuid4())})
-    else:
-        return 500, json.dumps({"success": False, "error": "Provider temporary unavailable"})
+    if not all([item.get('provider') or item.get('route'), item.get('recipient'), item.get('message')]):
+        return [], 'Missing required fields'
+    
+    if item.get('route') is not None and not valid_route(item['route']):
+        return [], 'Invalid route'
+    
+    if item.get('route_selection', 'ordered') not in ROUTE_SELECTIONS:
+        return [], 'Invalid route_selection'
+    
+    if not valid_idempotency_key(item.get('idempotency_key')):
+        return [], 'Invalid idempotency_key'
+    
+    route, error, _ = resolve_route(item.get('route') or [item['provider']], conn)
+    if route and item.get('route_selection') == 'fastest':
+        route = provider_stats.rank(route, conn)
+    return route, error
 
-def attempt_delivery(message_id: str, provider: str, recipient: str, 
-                    message_text: str, attempt_number: int, conn,
-                    template_name: Optional[str] = None, template_data: Optional[Dict] = None,
-                    subject: Optional[str] = None) -> Tuple[bool, Optional[str]]:
-    """Пытается доставить сообщение"""
-    start_time = time.time()
+def send_batch(items: List[Any], accept_async: bool, conn, api_key_id: Optional[int] = None) -> Dict[str, Any]:
+    """Проверяет, сохраняет и отправляет пачку сообщений
     
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT provider_type FROM providers WHERE provider_code = %s", (provider,))
-        result = cur.fetchone()
-        cur.close()
+    Все сообщения проверяются до записи в БД, корректные сохраняются одним INSERT
+    и отправляются движком доставки параллельно.
+    Некорректные получают статус rejected и не сохраняются.
+    Сообщения с уже принятым idempotency_key не отправляются повторно:
+    в результате возвращается прежнее сообщение с replayed = true.
+    """
+    results: List[Dict[str, Any]] = []
+    accepted: List[Dict] = []
+    
+    for index, item in enumerate(items):
+        route, error = validate_batch_item(item, conn)
         
-        provider_type = result['provider_type'] if result else None
+        if error:
+            results.append({'index': index, 'success': False, 'status': 'rejected', 'error': error})
+            continue
         
-        if provider_type in ['whatsapp_business', 'telegram_bot', 'wappi', 'max']:
-            status_code, response_body = send_via_wappi(recipient, message_text, provider, conn)
-        elif provider_type == 'yandex_postbox':
-            email_subject = subject or "Уведомление"
-            status_code, response_body = send_via_postbox(
-                recipient, message_text, email_subject, provider, conn,
-                template_name=template_name, template_data=template_data
-            )
-        else:
-            status_code, response_body = simulate_provider_send(provider, recipient, message_text)
+        message = {
+            'message_id': f"msg_{uuid.uuid4().hex[:16]}",
+            'provider': route[0].provider_code,
+            'route': route,
+            'recipient': item['recipient'],
+            'message_text': item['message'],
+            'metadata': item.get('metadata', {}),
+            'idempotency_key': item.get('idempotency_key'),
+            'delivery_options': {
+                'subject': item.get('subject'),
+                'template_name': item.get('template_name'),
+                'template_data': item.get('template_data'),
+                'route': item.get('route'),
+                'route_selection': item.get('route_selection')
+            }
+        }
+        accepted.append(message)
+        results.append({'index': index, 'message_id': message['message_id'], 'provider': message['provider']})
+    
+    if accepted:
+        existing = save_messages(accepted, conn, status='queued' if accept_async else 'pending',
+                                 api_key_id=api_key_id)
         
-        duration_ms = int((time.time() - start_time) * 1000)
+        replayed = {}
+        for m in accepted:
+            original = existing.get(m['idempotency_key']) if m['idempotency_key'] else None
+            if original and original['message_id'] != m['message_id']:
+                replayed[m['message_id']] = original
         
-        if status_code == 200:
-            log_attempt(message_id, attempt_number, provider, 'success', 
-                       status_code, response_body, None, duration_ms, conn)
-            return True, None
-        else:
-            error_msg = f"Provider returned status {status_code}"
-            log_attempt(message_id, attempt_number, provider, 'failed', 
-                       status_code, response_body, error_msg, duration_ms, conn)
-            return False, error_msg
-            
-    except Exception as e:
-        duration_ms = int((time.time() - start_time) * 1000)
-        error_msg = str(e)
-        log_attempt(message_id, attempt_number, provider, 'error', 
-                   None, '', error_msg, duration_ms, conn)
-        return False, error_msg
+        if replayed:
+            for r in results:
+                if r.get('message_id') in replayed:
+                    r.update(replay_result(replayed[r['message_id']]))
+            accepted = [m for m in accepted if m['message_id'] not in replayed]
+    
+    by_message_id = {r['message_id']: r for r in results if 'message_id' in r and not r.get('replayed')}
+    
+    if accept_async:
+        for r in by_message_id.values():
+            r.update({'success': True, 'status': 'queued'})
+    elif accepted:
+        jobs = [
+            DeliveryJob(
+                message_id=m['message_id'],
+                provider=m['route'][0],
+                recipient=m['recipient'],
+                message_text=m['message_text'],
+                options=m['delivery_options'],
+                route=tuple(m['route'])
+            )
+            for m in accepted
+        ]
+        deliver_inline(jobs, conn)
+        
+        for job in jobs:
+            by_message_id[job.message_id].update({
+                'provider': job.provider.provider_code,
+                'success': job.success,
+                'status': job_status(job),
+                'attempts': job.attempts,
+                'error': job.last_error,
+                'next_attempt_in': job.retry_in
+            })
+    
+    summary = {'total': len(items), 'accepted': len(accepted),
+               'replayed': sum(1 for r in results if r.get('replayed'))}
+    for r in results:
+        summary[r['status']] = summary.get(r['status'], 0) + 1
+    
+    return {'summary': summary, 'results': results}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -387,15 +2362,54 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         "metadata": {} (опционально),
         "subject": "Тема письма" (опционально, для email),
         "template_name": "имя_шаблона" (опционально, для Postbox),
-        "template_data": {"key": "value"} (опционально, данные для шаблона)
+        "template_data": {"key": "value"} (опционально, данные для шаблона),
+        "async": true (опционально, принять сообщение в очередь и сразу вернуть 202),
+        "idempotency_key": "order-123-receipt" (опционально, то же что заголовок Idempotency-Key),
+        "route": ["telegram_bot", "whatsapp_business", "sms_gateway"] (опционально, вместо provider),
+        "route_selection": "ordered|fastest" (опционально, по умолчанию ordered)
+    }
+    
+    Маршрут (route): каналы пробуются по порядку; после неудачи или при разомкнутой
+    цепи провайдера попытка сразу переходит на следующий канал. В ответе provider -
+    канал, которым сообщение доставлено (или последний опробованный).
+    С route_selection = fastest каналы считаются равноценными и пробуются
+    от лучшего по скользящим p95 длительности и доле успешных попыток.
+    
+    Пакетная отправка (до BATCH_MAX_SIZE сообщений):
+    Body: {
+        "messages": [{"provider": "...", "recipient": "...", "message": "...", ...}, ...],
+        "async": true (опционально)
     }
+    Ответ содержит summary и results с результатом по каждому сообщению (по index).
+    
+    Асинхронный режим:
+    - сообщение сохраняется со статусом queued, ответ 202 с message_id
+    - очередь разбирает планировщик: POST /api/send {"action": "drain_queue", "limit": 20}
+      (вызывается по таймеру, можно запускать несколько параллельно)
+    
+    Повторы: если попытки в запросе не помогли, сообщение получает next_attempt_at
+    и планировщик повторяет его с растущей задержкой до max_attempts попыток.
+    Пока цепь провайдера разомкнута (сбой у провайдера) или исчерпан его лимит
+    отправки (rate_limit в config), сообщение ставится в очередь без попыток
+    и возвращается 202 со status queued.
+    
+    Провайдеры Wappi с config.wappi_async = true отправляют через асинхронный
+    endpoint: сообщение получает статус sent и provider_message_id, итоговый
+    статус (delivered или failed) планировщик сверяет с Wappi пачками.
     
     Для Yandex Postbox:
     - Если указан template_name - отправка по шаблону (SendEmail с Template)
     - Если template_name не указан - обычное письмо (SendEmail с Simple)
     
+    Идемпотентность: повторный запрос с тем же Idempotency-Key (в пределах
+    IDEMPOTENCY_KEY_TTL и того же API ключа) не отправляет сообщение снова,
+    а возвращает прежние message_id и статус с replayed = true и тем HTTP кодом,
+    который соответствует текущему статусу (500 для failed, 202 пока не доставлено).
+    В пакете ключ задается полем idempotency_key у каждого сообщения.
+    
     Headers:
         X-Api-Key: ek_live_... или ek_test_...
+        Idempotency-Key: уникальный ключ запроса (опционально)
     """
     method = event.get('httpMethod', 'GET')
     
@@ -405,7 +2419,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key, Idempotency-Key',
                 'Access-Control-Max-Age': '86400',
                 'Content-Type': 'text/plain'
             },
@@ -421,6 +2435,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    conn = None
+    
     try:
         headers = event.get('headers', {})
         api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
@@ -434,8 +2450,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         conn = get_db_connection()
+        api_key_id = verify_api_key(api_key, conn)
         
-        if not verify_api_key(api_key, conn):
+        if api_key_id is None:
             conn.close()
             return {
                 'statusCode': 401,
@@ -446,15 +2463,75 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         body_data = json.loads(event.get('body', '{}'))
         
+        if body_data.get('action') == 'drain_queue':
+            try:
+                batch_size = int(body_data.get('limit', SCHEDULER_BATCH_SIZE))
+            except (TypeError, ValueError):
+                batch_size = 0
+            
+            if not 1 <= batch_size <= SCHEDULER_MAX_BATCH_SIZE:
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'error': 'Invalid limit',
+                        'message': f'limit must be an integer from 1 to {SCHEDULER_MAX_BATCH_SIZE}'
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            stats = run_scheduler(batch_size, SCHEDULER_TIME_BUDGET, conn)
+            conn.close()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, **stats}),
+                'isBase64Encoded': False
+            }
+        
+        if 'messages' in body_data:
+            items = body_data.get('messages')
+            
+            if not isinstance(items, list) or not items or len(items) > BATCH_MAX_SIZE:
+                conn.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'error': 'Invalid batch',
+                        'message': f'messages must be a non-empty array of at most {BATCH_MAX_SIZE} items'
+                    }),
+                    'isBase64Encoded': False
+                }
+            
+            accept_async = bool(body_data.get('async'))
+            batch_result = send_batch(items, accept_async, conn, api_key_id)
+            conn.close()
+            
+            return {
+                'statusCode': 202 if accept_async else 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, **batch_result}),
+                'isBase64Encoded': False
+            }
+        
         provider = body_data.get('provider')
+        route_codes = body_data.get('route')
+        route_selection = body_data.get('route_selection', 'ordered')
         recipient = body_data.get('recipient')
         message_text = body_data.get('message')
         metadata = body_data.get('metadata', {})
         template_name = body_data.get('template_name')
         template_data = body_data.get('template_data')
         subject = body_data.get('subject')
+        idempotency_key = (
+            headers.get('Idempotency-Key') or headers.get('idempotency-key')
+            or body_data.get('idempotency_key')
+        )
         
-        if not all([provider, recipient, message_text]):
+        if not all([provider or route_codes, recipient, message_text]):
             conn.close()
             return {
                 'statusCode': 400,
@@ -466,73 +2543,155 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        is_active, provider_name = check_provider_active(provider, conn)
+        if route_codes is not None and not valid_route(route_codes):
+            conn.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'Invalid route',
+                    'message': f'route must be a non-empty array of at most {ROUTE_MAX_LENGTH} provider codes'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if route_selection not in ROUTE_SELECTIONS:
+            conn.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'Invalid route_selection',
+                    'allowed': list(ROUTE_SELECTIONS)
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if not valid_idempotency_key(idempotency_key):
+            conn.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'Invalid idempotency key',
+                    'message': f'Idempotency-Key must be a non-empty string of at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'
+                }),
+                'isBase64Encoded': False
+            }
+        
+        route, route_error, route_error_provider = resolve_route(route_codes or [provider], conn)
         
-        if not provider_name:
+        if route_error == 'Unknown provider':
             conn.close()
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'error': 'Unknown provider',
-                    'provider': provider,
+                    'provider': route_error_provider,
                     'available_providers': ['sms_gateway', 'whatsapp_business', 'telegram_bot', 'email_service', 'push_service']
                 }),
                 'isBase64Encoded': False
             }
         
-        if not is_active:
+        if route_error == 'Provider inactive':
+            provider_record = get_provider(route_error_provider, conn)
             conn.close()
             return {
                 'statusCode': 503,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
                     'error': 'Provider inactive',
-                    'provider': provider,
-                    'provider_name': provider_name,
-                    'message': f'{provider_name} is currently inactive'
+                    'provider': route_error_provider,
+                    'provider_name': provider_record.provider_name,
+                    'message': f'{provider_record.provider_name} is currently inactive'
                 }),
                 'isBase64Encoded': False
             }
         
+        if route_selection == 'fastest':
+            route = provider_stats.rank(route, conn)
+        
+        provider = route[0].provider_code
         message_id = f"msg_{uuid.uuid4().hex[:16]}"
+        delivery_options = {
+            'subject': subject,
+            'template_name': template_name,
+            'template_data': template_data,
+            'route': route_codes,
+            'route_selection': route_selection
+        }
         
-        save_message(message_id, provider, recipient, message_text, metadata, conn)
+        original = save_message(message_id, provider, recipient, message_text, metadata, conn,
+                                status='queued' if body_data.get('async') else 'pending',
+                                delivery_options=delivery_options,
+                                api_key_id=api_key_id, idempotency_key=idempotency_key)
         
-        max_attempts = 3
-        retry_delays = [0, 1, 3]
+        if original:
+            conn.close()
+            return {
+                'statusCode': replay_status_code(original['status']),
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(replay_result(original)),
+                'isBase64Encoded': False
+            }
         
-        last_error = None
-        for attempt in range(1, max_attempts + 1):
-            if attempt > 1:
-                time.sleep(retry_delays[attempt - 1])
-            
-            success, error = attempt_delivery(
-                message_id, provider, recipient, message_text, attempt, conn,
-                template_name=template_name, template_data=template_data, subject=subject
-            )
-            
-            if success:
-                update_message_status(message_id, 'delivered', attempt, None, conn)
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'message_id': message_id,
-                        'provider': provider,
-                        'status': 'delivered',
-                        'attempts': attempt
-                    }),
-                    'isBase64Encoded': False
-                }
+        if body_data.get('async'):
+            conn.close()
             
-            last_error = error
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'queued'
+                }),
+                'isBase64Encoded': False
+            }
         
-        update_message_status(message_id, 'failed', max_attempts, last_error, conn)
+        job = DeliveryJob(
+            message_id=message_id,
+            provider=route[0],
+            recipient=recipient,
+            message_text=message_text,
+            options=delivery_options,
+            route=tuple(route)
+        )
+        deliver_inline([job], conn)
         conn.close()
+        provider = job.provider.provider_code
+        
+        if job_status(job) == 'queued':
+            return {
+                'statusCode': 202,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': 'queued',
+                    'reason': job.defer_reason,
+                    'next_attempt_in': job.retry_in
+                }),
+                'isBase64Encoded': False
+            }
+        
+        if job.success:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message_id': message_id,
+                    'provider': provider,
+                    'status': job_status(job),
+                    'provider_message_id': job.provider_message_id,
+                    'attempts': job.attempts
+                }),
+                'isBase64Encoded': False
+            }
         
         return {
             'statusCode': 500,
@@ -542,9 +2701,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'message_id': message_id,
                 'provider': provider,
                 'status': 'failed',
-                'attempts': max_attempts,
-                'error': last_error,
-                'message': f'Failed to deliver after {max_attempts} attempts. Message saved for manual retry.'
+                'attempts': job.attempts,
+                'error': job.last_error,
+                'next_attempt_in': job.retry_in,
+                'message': (
+                    f'Failed to deliver after {job.attempts} attempts. Next automatic attempt in {job.retry_in:g}s.'
+                    if job.retry_in is not None else
+                    f'Failed to deliver after {job.attempts} attempts. Message saved for manual retry.'
+                )
             }),
             'isBase64Encoded': False
         }
@@ -562,4 +2726,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
@@ -0,0 +1,363 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_HEALTHCHECK_AFTER = float(os.environ.get('DB_POOL_HEALTHCHECK_AFTER', '30'))
+
+class ConnectionPool:
+    """Пул подключений к БД, который живет в теплом контейнере между вызовами"""
+    
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[Tuple[Any, float]] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+    
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """Проверяет подключение через SELECT 1, если оно долго простаивало"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def acquire(self):
+        """Берет свободное подключение или открывает новое в пределах max_size"""
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, idle_since = None, 0.0
+        
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError(f"No free database connections (max_size={self.max_size})")
+                self._cond.wait(remaining)
+        
+        if conn is not None:
+            if self._is_healthy(conn, idle_since):
+                return conn
+            print("[DB POOL] Dropping broken connection, reconnecting")
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+    
+    def release(self, conn) -> None:
+        """Возвращает подключение в пул; оборванное подключение закрывается"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        
+        with self._cond:
+            if broken:
+                self._size -= 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул вместо закрытия сокета"""
+    
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._pool.release(self._conn)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_connection() -> PooledConnection:
+    """Берет подключение к базе данных из общего пула"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(
+                    os.environ['DATABASE_URL'],
+                    max_size=DB_POOL_MAX_SIZE,
+                    acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_AFTER
+                )
+    return PooledConnection(_db_pool.acquire(), _db_pool)
+
+def verify_api_key(api_key: str, conn) -> bool:
+    """Проверяет валидность API ключа"""
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT id FROM api_keys
+        WHERE api_key = %s AND is_active = true
+          AND (expiry_date IS NULL OR expiry_date > NOW())""",
+        (api_key,)
+    )
+    result = cur.fetchone()
+    cur.close()
+    return result is not None
+
+STATS_LATENCY_BOUNDS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+STATS_RESOLUTIONS = ('auto', 'minute', 'hour')
+STATS_DEFAULT_RANGE = timedelta(hours=int(os.environ.get('STATS_DEFAULT_RANGE_HOURS', '24')))
+STATS_MINUTE_MAX_RANGE = timedelta(hours=int(os.environ.get('STATS_MINUTE_MAX_RANGE_HOURS', '24')))
+STATS_MAX_RANGE = timedelta(days=int(os.environ.get('STATS_MAX_RANGE_DAYS', '90')))
+
+def parse_time(value: Optional[str], field: str) -> Optional[datetime]:
+    """Граница периода из ISO 8601; время с часовым поясом переводится в UTC"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError as e:
+        raise ValueError(f'Invalid {field}') from e
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def histogram_percentile(latency_buckets: List[int], quantile: float, max_ms: int) -> Optional[int]:
+    """Оценка перцентиля длительности по гистограмме: верхняя граница корзины, не больше максимума"""
+    total = sum(latency_buckets)
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for index, count in enumerate(latency_buckets):
+        seen += count
+        if seen >= rank:
+            if index < len(STATS_LATENCY_BOUNDS):
+                return min(STATS_LATENCY_BOUNDS[index], max_ms)
+            return max_ms
+    return max_ms
+
+def summarize(rows: List[Dict]) -> Dict[str, Any]:
+    """Сводка по набору корзин: счетчики складываются, гистограммы - поэлементно"""
+    attempts = sum(row['attempts'] for row in rows)
+    successes = sum(row['successes'] for row in rows)
+    duration_sum = sum(row['duration_ms_sum'] for row in rows)
+    max_ms = max((row['duration_ms_max'] for row in rows), default=0)
+    latency_buckets = [0] * (len(STATS_LATENCY_BOUNDS) + 1)
+    for row in rows:
+        for index, count in enumerate(row['latency_buckets'] or []):
+            latency_buckets[index] += count
+    
+    return {
+        'attempts': attempts,
+        'successes': successes,
+        'failures': attempts - successes,
+        'success_rate': round(successes / attempts, 4) if attempts else None,
+        'avg_ms': round(duration_sum / attempts) if attempts else None,
+        'p50_ms': histogram_percentile(latency_buckets, 0.5, max_ms),
+        'p95_ms': histogram_percentile(latency_buckets, 0.95, max_ms),
+        'max_ms': max_ms if attempts else None
+    }
+
+def load_rollups(resolution: str, start: datetime, end: datetime, provider: Optional[str], conn) -> List[Dict]:
+    """Корзины delivery_stats_rollups за период по первичному ключу (bucket_size, bucket_start)"""
+    conditions = ["bucket_size = %s", "bucket_start >= date_trunc(%s, %s::TIMESTAMP)", "bucket_start < %s"]
+    params: List[Any] = [resolution, resolution, start, end]
+    if provider:
+        conditions.append("provider_code = %s")
+        params.append(provider)
+    
+    cur = conn.cursor()
+    cur.execute(
+        f"""SELECT bucket_start, provider_code, attempts, successes,
+               duration_ms_sum, duration_ms_max, latency_buckets
+        FROM delivery_stats_rollups
+        WHERE {' AND '.join(conditions)}
+        ORDER BY provider_code, bucket_start""",
+        params
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """
+    Статистика доставки по провайдерам для дашборда
+    
+    GET /api/stats?from=2026-01-01T00:00:00&to=2026-01-31T00:00:00&provider=sms_gateway&resolution=auto
+    Все параметры необязательны, по умолчанию - последние STATS_DEFAULT_RANGE_HOURS часов.
+    resolution: minute, hour или auto (минуты для периода до суток, иначе часы).
+    Для каждого провайдера возвращаются итоги за период и ряд по корзинам:
+    попытки, успехи, доля успехов, средняя длительность, p50/p95 (по гистограмме) и максимум.
+    Данные берутся из delivery_stats_rollups, которые пополняются при записи попыток.
+    """
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Api-Key',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method != 'GET':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = None
+    
+    try:
+        headers = event.get('headers', {})
+        api_key = headers.get('x-api-key') or headers.get('X-Api-Key')
+        
+        if not api_key:
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Missing API key'}),
+                'isBase64Encoded': False
+            }
+        
+        params = event.get('queryStringParameters') or {}
+        
+        try:
+            end = parse_time(params.get('to'), 'to') or datetime.now(timezone.utc).replace(tzinfo=None)
+            start = parse_time(params.get('from'), 'from') or end - STATS_DEFAULT_RANGE
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        
+        resolution = params.get('resolution') or 'auto'
+        if resolution not in STATS_RESOLUTIONS:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid resolution', 'allowed': list(STATS_RESOLUTIONS)}),
+                'isBase64Encoded': False
+            }
+        if resolution == 'auto':
+            resolution = 'minute' if end - start <= STATS_MINUTE_MAX_RANGE else 'hour'
+        
+        if not start < end or end - start > STATS_MAX_RANGE or (
+                resolution == 'minute' and end - start > STATS_MINUTE_MAX_RANGE):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': 'Invalid range',
+                    'max_days': STATS_MAX_RANGE.days,
+                    'minute_max_hours': int(STATS_MINUTE_MAX_RANGE.total_seconds() // 3600)
+                }),
+                'isBase64Encoded': False
+            }
+        
+        conn = get_db_connection()
+        
+        if not verify_api_key(api_key, conn):
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid API key'}),
+                'isBase64Encoded': False
+            }
+        
+        rows = load_rollups(resolution, start, end, params.get('provider'), conn)
+        
+        by_provider: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_provider.setdefault(row['provider_code'], []).append(row)
+        
+        providers = [
+            {
+                'provider_code': provider_code,
+                'totals': summarize(provider_rows),
+                'series': [
+                    {'bucket_start': row['bucket_start'].isoformat(), **summarize([row])}
+                    for row in provider_rows
+                ]
+            }
+            for provider_code, provider_rows in by_provider.items()
+        ]
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'success': True,
+                'resolution': resolution,
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'totals': summarize(rows),
+                'providers': providers
+            }),
+            'isBase64Encoded': False
+        }
+        
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Internal server error', 'details': str(e)}),
+            'isBase64Encoded': False
+        }
+    finally:
+        if conn is not None:
+            conn.close()
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Versions of in-process caches kept by warm functions.
+-- Writers bump the version; readers poll it and drop their cached entries on change.
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    cache_name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+INSERT INTO cache_invalidations (cache_name) VALUES
+('api_keys')
+ON CONFLICT (cache_name) DO NOTHING;
@@ -0,0 +1,5 @@
+-- Delivery options (subject, template) are stored with the message so that
+-- messages accepted in async mode can be delivered later by the queue worker
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS delivery_options JSONB DEFAULT '{}';
+
+CREATE INDEX IF NOT EXISTS idx_messages_queued ON messages(created_at) WHERE status = 'queued';
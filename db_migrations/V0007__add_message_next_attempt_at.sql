@@ -0,0 +1,12 @@
+-- Persistent retry schedule: a message is due for (re)delivery when next_attempt_at <= NOW().
+-- While a message is being delivered, next_attempt_at holds the lease expiry, so messages
+-- left behind by a crashed function instance become due again automatically.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_messages_next_attempt_at ON messages(next_attempt_at)
+WHERE next_attempt_at IS NOT NULL;
+
+DROP INDEX IF EXISTS idx_messages_queued;
+
+UPDATE messages SET next_attempt_at = created_at WHERE status = 'queued';
+UPDATE messages SET next_attempt_at = NOW() WHERE status IN ('pending', 'processing');
@@ -0,0 +1,9 @@
+-- Circuit breaker state per provider, shared by all function instances.
+-- open: attempts to the provider are skipped until open_until; after that a probe
+-- attempt decides whether the circuit closes again or reopens.
+CREATE TABLE IF NOT EXISTS provider_circuits (
+    provider_code VARCHAR(50) PRIMARY KEY,
+    state VARCHAR(20) NOT NULL DEFAULT 'closed',
+    open_until TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,7 @@
+-- Token buckets for outbound rate limits (per provider and per Wappi profile).
+-- tokens may go negative: that is capacity already promised to attempts waiting for it.
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    bucket_key VARCHAR(150) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,9 @@
+-- Idempotency keys for POST /api/send, scoped to the API key that sent the message.
+-- A key is honored until idempotency_expires_at; after that it is released on the next
+-- send with the same key, so the unique index only covers keys still in their window.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS api_key_id INT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(255);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS idempotency_expires_at TIMESTAMP;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_idempotency_key ON messages(api_key_id, idempotency_key)
+WHERE idempotency_key IS NOT NULL;
@@ -0,0 +1,8 @@
+-- Provider-side reference of a message accepted by an asynchronous endpoint (Wappi async).
+-- Such messages stay in status 'sent' until reconciliation polls the provider for the final
+-- delivery state; next_attempt_at then holds the time of the next status check.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS provider_message_id VARCHAR(255);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS provider_profile_id VARCHAR(100);
+
+CREATE INDEX IF NOT EXISTS idx_messages_sent_next_attempt_at ON messages(next_attempt_at)
+WHERE status = 'sent';
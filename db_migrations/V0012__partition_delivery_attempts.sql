@@ -0,0 +1,61 @@
+-- Range-partition delivery_attempts by month of attempted_at.
+-- The current table is renamed, its rows are copied into monthly partitions
+-- (delivery_attempts_yYYYYmMM) and it is dropped; rows outside the created months
+-- go to delivery_attempts_default. Partitions for the coming months are created and
+-- expired ones are detached and archived by the maintenance function.
+DO $$
+DECLARE
+    partition_month DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'delivery_attempts' AND relkind = 'p') THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE delivery_attempts RENAME TO delivery_attempts_unpartitioned;
+    ALTER TABLE delivery_attempts_unpartitioned RENAME CONSTRAINT delivery_attempts_pkey TO delivery_attempts_unpartitioned_pkey;
+    ALTER INDEX IF EXISTS idx_delivery_attempts_message_id RENAME TO idx_delivery_attempts_unpartitioned_message_id;
+    ALTER INDEX IF EXISTS idx_delivery_attempts_attempted_at RENAME TO idx_delivery_attempts_unpartitioned_attempted_at;
+
+    CREATE TABLE delivery_attempts (
+        id INT NOT NULL DEFAULT nextval('delivery_attempts_id_seq'),
+        message_id VARCHAR(100) NOT NULL,
+        attempt_number INT NOT NULL,
+        provider VARCHAR(50) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        response_code INT,
+        response_body TEXT,
+        error_message TEXT,
+        duration_ms INT,
+        attempted_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id, attempted_at)
+    ) PARTITION BY RANGE (attempted_at);
+    ALTER SEQUENCE delivery_attempts_id_seq OWNED BY delivery_attempts.id;
+
+    SELECT date_trunc('month', COALESCE(MIN(attempted_at), NOW()))::date
+    INTO partition_month
+    FROM delivery_attempts_unpartitioned;
+
+    WHILE partition_month <= (date_trunc('month', NOW()) + INTERVAL '2 months')::date LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF delivery_attempts FOR VALUES FROM (%L) TO (%L)',
+            'delivery_attempts_' || to_char(partition_month, '"y"YYYY"m"MM'),
+            partition_month,
+            (partition_month + INTERVAL '1 month')::date
+        );
+        partition_month := (partition_month + INTERVAL '1 month')::date;
+    END LOOP;
+    CREATE TABLE IF NOT EXISTS delivery_attempts_default PARTITION OF delivery_attempts DEFAULT;
+
+    INSERT INTO delivery_attempts
+        (id, message_id, attempt_number, provider, status, response_code,
+         response_body, error_message, duration_ms, attempted_at)
+    SELECT id, message_id, attempt_number, provider, status, response_code,
+           response_body, error_message, duration_ms, COALESCE(attempted_at, NOW())
+    FROM delivery_attempts_unpartitioned;
+
+    DROP TABLE delivery_attempts_unpartitioned;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_delivery_attempts_message_id ON delivery_attempts(message_id);
+CREATE INDEX IF NOT EXISTS idx_delivery_attempts_attempted_at ON delivery_attempts(attempted_at DESC);
+CREATE INDEX IF NOT EXISTS idx_delivery_attempts_provider_attempted_at ON delivery_attempts(provider, attempted_at DESC);
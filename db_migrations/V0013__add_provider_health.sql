@@ -0,0 +1,45 @@
+-- Per-provider delivery health, maintained by the send and retry functions in the same
+-- transaction that logs delivery attempts, so the providers listing reads one row per
+-- provider instead of scanning delivery_attempts.
+-- success_rate is an exponentially weighted share of successful attempts,
+-- recent_latencies holds duration_ms of the latest attempts, oldest first.
+CREATE TABLE IF NOT EXISTS provider_health (
+    provider_code VARCHAR(50) PRIMARY KEY,
+    last_status VARCHAR(20),
+    last_response_code INT,
+    last_attempt_at TIMESTAMP,
+    success_rate DOUBLE PRECISION,
+    attempts_total BIGINT NOT NULL DEFAULT 0,
+    recent_latencies INT[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+INSERT INTO provider_health
+    (provider_code, last_status, last_response_code, last_attempt_at, success_rate, attempts_total, recent_latencies)
+SELECT last.provider, last.status, last.response_code, last.attempted_at,
+       totals.success_rate, totals.attempts_total,
+       ARRAY(
+           SELECT latest.duration_ms
+           FROM (
+               SELECT duration_ms, attempted_at
+               FROM delivery_attempts
+               WHERE provider = last.provider AND duration_ms IS NOT NULL
+               ORDER BY attempted_at DESC
+               LIMIT 20
+           ) latest
+           ORDER BY latest.attempted_at
+       )
+FROM (
+    SELECT DISTINCT ON (provider) provider, status, response_code, attempted_at
+    FROM delivery_attempts
+    ORDER BY provider, attempted_at DESC
+) last
+JOIN (
+    SELECT provider,
+           AVG(CASE WHEN status = 'success' THEN 1.0 ELSE 0.0 END)
+               FILTER (WHERE attempted_at > NOW() - INTERVAL '1 day') AS success_rate,
+           COUNT(*) AS attempts_total
+    FROM delivery_attempts
+    GROUP BY provider
+) totals ON totals.provider = last.provider
+ON CONFLICT (provider_code) DO NOTHING;
@@ -0,0 +1,7 @@
+-- Bounded storage of provider responses. response_body keeps only the beginning of the
+-- response; the whole (size-capped) body is stored gzip-compressed in response_body_gz when
+-- the provider's response_body_policy asks for it. The provider message id and error code
+-- are extracted into their own columns.
+ALTER TABLE delivery_attempts ADD COLUMN IF NOT EXISTS provider_message_id VARCHAR(255);
+ALTER TABLE delivery_attempts ADD COLUMN IF NOT EXISTS error_code VARCHAR(100);
+ALTER TABLE delivery_attempts ADD COLUMN IF NOT EXISTS response_body_gz BYTEA;
@@ -0,0 +1,43 @@
+-- Delivery statistics per provider, rolled up per minute and per hour (bucket_size is the
+-- date_trunc field). The send and retry functions add to the current buckets in the same
+-- transaction that logs delivery attempts; the stats function reads only these rows.
+-- latency_buckets is a histogram of duration_ms: element i counts attempts with
+-- 50, 100, 250, 500, 1000, 2500, 5000, 10000 thresholds below or equal to the duration
+-- (width_bucket semantics), i.e. [0,50), [50,100), ... [10000, inf).
+CREATE TABLE IF NOT EXISTS delivery_stats_rollups (
+    bucket_size VARCHAR(10) NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    provider_code VARCHAR(50) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    successes INT NOT NULL DEFAULT 0,
+    duration_ms_sum BIGINT NOT NULL DEFAULT 0,
+    duration_ms_max INT NOT NULL DEFAULT 0,
+    latency_buckets INT[] NOT NULL DEFAULT '{0,0,0,0,0,0,0,0,0}',
+    PRIMARY KEY (bucket_size, bucket_start, provider_code)
+);
+
+INSERT INTO delivery_stats_rollups
+    (bucket_size, bucket_start, provider_code, attempts, successes,
+     duration_ms_sum, duration_ms_max, latency_buckets)
+SELECT sizes.bucket_size, date_trunc(sizes.bucket_size, a.attempted_at), a.provider,
+       COUNT(*),
+       COUNT(*) FILTER (WHERE a.status = 'success'),
+       COALESCE(SUM(a.duration_ms), 0),
+       COALESCE(MAX(a.duration_ms), 0),
+       ARRAY[
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 0),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 1),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 2),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 3),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 4),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 5),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 6),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 7),
+           COUNT(*) FILTER (WHERE width_bucket(COALESCE(a.duration_ms, 0), thresholds.bounds) = 8)
+       ]::INT[]
+FROM delivery_attempts a
+CROSS JOIN (VALUES ('minute'), ('hour')) AS sizes(bucket_size)
+CROSS JOIN (SELECT ARRAY[50, 100, 250, 500, 1000, 2500, 5000, 10000] AS bounds) thresholds
+WHERE a.attempted_at > NOW() - INTERVAL '30 days'
+GROUP BY sizes.bucket_size, date_trunc(sizes.bucket_size, a.attempted_at), a.provider
+ON CONFLICT (bucket_size, bucket_start, provider_code) DO NOTHING;